@@ -0,0 +1,302 @@
+# JSON API for machine clients, served under /api/v1
+#
+# Reuses the services and schemas of the HTML views, takes JSON bodies and
+# serializes through orjson
+#
+# @zgr2788
+
+import fastapi as _fastapi
+import fastapi.responses as _responses
+import pydantic as _pydantic
+import sqlalchemy.orm as _orm
+from typing import List, Union
+import services as _services, schemas as _schemas, cache as _cache
+
+router = _fastapi.APIRouter(prefix = "/api/v1", default_response_class = _responses.ORJSONResponse)
+
+
+# Listing page with its cursor
+class _Page(_pydantic.BaseModel):
+    next_cursor : Union[int, None]
+
+class DoctorPage(_Page):
+    items : List[_schemas.Doctor]
+
+class NursePage(_Page):
+    items : List[_schemas.Nurse]
+
+class ServicePage(_Page):
+    items : List[_schemas.Service]
+
+class RoomPage(_Page):
+    items : List[_schemas.Room]
+
+class PatientPage(_Page):
+    items : List[_schemas.Patient]
+
+class BillReport(_pydantic.BaseModel):
+    items : List[_schemas.BillTotal]
+    next_cursor : Union[str, None]
+
+class PatientBills(_pydantic.BaseModel):
+    patient_id : int
+    count : int
+    total : int
+    treatments : List[_schemas.Treatment]
+
+class Admission(_pydantic.BaseModel):
+    patient_id : int
+    room_id : int
+
+class Allocation(_pydantic.BaseModel):
+    patient_id : int
+    min_size : int
+
+class AdmissionResult(_pydantic.BaseModel):
+    patient : _schemas.Patient
+    room : _schemas.Room
+
+class AdmissionBatch(_pydantic.BaseModel):
+    admissions : List[Admission] = []
+    discharges : List[int] = []
+    atomic : bool = False
+
+class BatchItemResult(_pydantic.BaseModel):
+    action : str
+    patient_id : int
+    room_id : Union[int, None]
+    status : int
+    detail : str
+
+class AdmissionBatchResult(_pydantic.BaseModel):
+    applied : bool
+    results : List[BatchItemResult]
+
+
+# 404 on missing rows
+def _found(obj, detail : str):
+    if obj is None:
+        raise _fastapi.HTTPException(status_code=404, detail = detail)
+    return obj
+
+
+#*********************************************************
+
+# DOCTORS
+
+#*********************************************************
+
+@router.get("/doctors", response_model = DoctorPage)
+async def list_doctors(after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_docs_page(db, after_id = after, limit = limit)
+    return DoctorPage(items = items, next_cursor = next_cursor)
+
+@router.get("/doctors/search", response_model = DoctorPage)
+async def search_doctors(name : str = "", spec : str = "", after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if spec:
+        items, next_cursor = await _services.get_docs_by_spec(spec, db, after_id = after, limit = limit)
+    else:
+        items, next_cursor = await _services.get_docs_by_name(name, db, after_id = after, limit = limit)
+    return DoctorPage(items = items, next_cursor = next_cursor)
+
+@router.get("/doctors/{doc_id}", response_model = _schemas.Doctor)
+async def get_doctor(doc_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return _found(await _services.get_doc_by_id(doc_id, db), "Doctor ID not found in database!")
+
+@router.post("/doctors", response_model = _schemas.Doctor, status_code = 201)
+async def create_doctor(doc : _schemas._DoctorCreate, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return await _services.create_doc(doc, db)
+
+@router.delete("/doctors/{doc_id}", status_code = 204)
+async def delete_doctor(doc_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    await _services.delete_doc(doc_id, db)
+
+
+#*********************************************************
+
+# NURSES
+
+#*********************************************************
+
+@router.get("/nurses", response_model = NursePage)
+async def list_nurses(after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_nurses_page(db, after_id = after, limit = limit)
+    return NursePage(items = items, next_cursor = next_cursor)
+
+@router.get("/nurses/search", response_model = NursePage)
+async def search_nurses(name : str = "", after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_nurs_by_name(name, db, after_id = after, limit = limit)
+    return NursePage(items = items, next_cursor = next_cursor)
+
+@router.get("/nurses/{nur_id}", response_model = _schemas.Nurse)
+async def get_nurse(nur_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return _found(await _services.get_nur_by_id(nur_id, db), "Nurse ID not found in database!")
+
+@router.post("/nurses", response_model = _schemas.Nurse, status_code = 201)
+async def create_nurse(nur : _schemas._NurseCreate, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return await _services.create_nur(nur, db)
+
+@router.delete("/nurses/{nur_id}", status_code = 204)
+async def delete_nurse(nur_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    await _services.delete_nur(nur_id, db)
+
+
+#*********************************************************
+
+# SERVICES
+
+#*********************************************************
+
+@router.get("/services", response_model = ServicePage)
+async def list_services(after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_sers_page(db, after_id = after, limit = limit)
+    return ServicePage(items = items, next_cursor = next_cursor)
+
+@router.get("/services/search", response_model = ServicePage)
+async def search_services(name : str = "", after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_sers_by_name(name, db, after_id = after, limit = limit)
+    return ServicePage(items = items, next_cursor = next_cursor)
+
+@router.get("/services/{ser_id}", response_model = _schemas.Service)
+async def get_service(ser_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return _found(await _services.get_ser_by_id(ser_id, db), "Personnel ID not found in database!")
+
+@router.post("/services", response_model = _schemas.Service, status_code = 201)
+async def create_service(ser : _schemas._ServiceCreate, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return await _services.create_ser(ser, db)
+
+@router.delete("/services/{ser_id}", status_code = 204)
+async def delete_service(ser_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    await _services.delete_ser(ser_id, db)
+
+
+#*********************************************************
+
+# ROOMS
+
+#*********************************************************
+
+@router.get("/rooms", response_model = RoomPage)
+async def list_rooms(after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_ros_page(db, after_id = after, limit = limit)
+    return RoomPage(items = items, next_cursor = next_cursor)
+
+@router.get("/rooms/search", response_model = RoomPage)
+async def search_rooms(name : str = "", after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_ros_by_name(name, db, after_id = after, limit = limit)
+    return RoomPage(items = items, next_cursor = next_cursor)
+
+@router.get("/rooms/{ro_id}", response_model = _schemas.Room)
+async def get_room(ro_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return _found(await _services.get_ro_by_id(ro_id, db), "Room ID not found in database!")
+
+@router.post("/rooms", response_model = _schemas.Room, status_code = 201)
+async def create_room(ro : _schemas._RoomCreate, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return await _services.create_ro(ro, db)
+
+@router.delete("/rooms/{ro_id}", status_code = 204)
+async def delete_room(ro_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    await _services.delete_ro(ro_id, db)
+
+
+#*********************************************************
+
+# PATIENTS
+
+#*********************************************************
+
+@router.get("/patients", response_model = PatientPage)
+async def list_patients(after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_pats_page(db, after_id = after, limit = limit)
+    return PatientPage(items = items, next_cursor = next_cursor)
+
+@router.get("/patients/search", response_model = PatientPage)
+async def search_patients(name : str = "", after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    items, next_cursor = await _services.get_pats_by_name(name, db, after_id = after, limit = limit)
+    return PatientPage(items = items, next_cursor = next_cursor)
+
+@router.get("/patients/{pat_id}", response_model = _schemas.Patient)
+async def get_patient(pat_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    return _found(await _services.get_pat_by_id(pat_id, db), "Patient ID not found in database!")
+
+@router.post("/patients", response_model = _schemas.Patient, status_code = 201)
+async def create_patient(pat : _schemas._PatientCreate, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    _found(await _services.get_doc_by_id(pat.treated_by, db), "Doctor ID not found in database!")
+    return await _services.create_pat(pat, db)
+
+@router.delete("/patients/{pat_id}", status_code = 204)
+async def delete_patient(pat_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    await _services.delete_pat(pat_id, db)
+
+
+#*********************************************************
+
+# TREATMENTS & BILLING
+
+#*********************************************************
+
+@router.post("/treatments", response_model = _schemas.Treatment, status_code = 201)
+async def create_treatment(trt : _schemas._TreatmentCreate, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    _found(await _services.get_pat_by_id(trt.billed_to, db), "Patient ID not found in database!")
+    return await _services.create_trt(trt, db)
+
+@router.get("/patients/{pat_id}/bills", response_model = PatientBills)
+async def patient_bills(pat_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    _, treatments, total, count = _found(await _services.get_pat_bills(pat_id, db), "Patient ID not found in database!")
+    return PatientBills(patient_id = pat_id, count = count, total = total, treatments = treatments)
+
+@router.get("/bills/report", response_model = BillReport)
+async def bill_report(sort : str = "amount", after : str = "", limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if sort not in _services.BILL_REPORT_SORTS:
+        raise _fastapi.HTTPException(status_code=400, detail = "Sort must be one of " + ", ".join(_services.BILL_REPORT_SORTS) + "!")
+
+    try:
+        items, next_cursor = await _services.get_bill_report(db, sort = sort, after = after, limit = limit)
+    except ValueError:
+        raise _fastapi.HTTPException(status_code=400, detail = "Invalid cursor!")
+
+    return BillReport(items = items, next_cursor = next_cursor)
+
+
+#*********************************************************
+
+# ADMISSION
+
+#*********************************************************
+
+@router.post("/admissions", response_model = _schemas.Patient)
+async def admit_patient(admission : Admission, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    pat_db, _ = await _services.admit_pat(admission.patient_id, admission.room_id, db)
+    return pat_db
+
+@router.post("/admissions/allocate", response_model = AdmissionResult)
+async def allocate_room(allocation : Allocation, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    pat_db, ro_db = await _services.allocate_ro(allocation.patient_id, allocation.min_size, db)
+    return AdmissionResult(patient = _schemas.Patient.from_orm(pat_db), room = _schemas.Room.from_orm(ro_db))
+
+# Discharges first, then admissions, in one transaction with a result per item
+@router.post("/admissions/batch", response_model = AdmissionBatchResult)
+async def admission_batch(batch : AdmissionBatch, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if len(batch.admissions) + len(batch.discharges) > _services.BATCH_MAX:
+        raise _fastapi.HTTPException(status_code=400, detail = "At most " + str(_services.BATCH_MAX) + " items per batch!")
+
+    admissions = [(item.patient_id, item.room_id) for item in batch.admissions]
+    results, applied = await _services.apply_admissions(admissions, batch.discharges, db, atomic = batch.atomic)
+    return AdmissionBatchResult(applied = applied, results = results)
+
+@router.post("/discharges/{pat_id}", response_model = _schemas.Patient)
+async def discharge_patient(pat_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    pat_db, _ = await _services.discharge_pat(pat_id, db)
+    return pat_db
+
+
+#*********************************************************
+
+# CACHE
+
+#*********************************************************
+
+# Hit / miss counters of this worker's entity cache
+@router.get("/cache")
+async def cache_stats():
+    return _cache.entities.stats()
@@ -0,0 +1,3 @@
+# Benchmarks for the backend, run from the repository root
+#
+# python -m benchmarks.<name>
@@ -0,0 +1,96 @@
+# Admission contention benchmark
+#
+# Many threads admit random patients to random rooms and discharge them again,
+# all fighting over a small ward. Reports throughput and conflicts, then checks
+# that no room holds two patients and no patient sits in two rooms.
+#
+# python -m benchmarks.admission_contention [--rooms 20] [--patients 200] [--threads 16] [--seconds 5]
+
+import argparse as _argparse
+import os as _os
+import random as _rnd
+import tempfile as _tempfile
+import threading as _threading
+import time as _time
+
+_tmpdir = _tempfile.mkdtemp(prefix = "hadmdb-bench-")
+# Always a scratch database, the benchmark writes and deletes rows, a configured database is never used
+_os.environ["HADMDB_DATABASE_URL"] = "sqlite:///" + _os.path.join(_tmpdir, "bench.db")
+
+import fastapi as _fastapi
+import sqlalchemy as _sql
+import database as _database, models as _models, services as _services
+
+
+def seed(rooms : int, patients : int):
+    _services.create_database()
+
+    with _database.engine.begin() as conn:
+        conn.execute(_sql.insert(_models.Doctor), [{"name" : "Doctor", "spec" : "Surgeon"}])
+        conn.execute(_sql.insert(_models.Room), [{"name" : "Room %d" % i, "size" : 100} for i in range(rooms)])
+        conn.execute(_sql.insert(_models.Patient), [{"name" : "Patient %d" % i, "history" : "", "treated_by" : 1} for i in range(patients)])
+
+
+# Rooms with more than one patient, patients in more than one room, and one-sided links
+def check(conn):
+    double_rooms = conn.execute(_sql.text("SELECT COUNT(*) FROM (SELECT admitted_to FROM patients WHERE admitted_to != 0 GROUP BY admitted_to HAVING COUNT(*) > 1)")).scalar()
+    double_pats = conn.execute(_sql.text("SELECT COUNT(*) FROM (SELECT occupied_by FROM rooms WHERE occupied GROUP BY occupied_by HAVING COUNT(*) > 1)")).scalar()
+    dangling = conn.execute(_sql.text("SELECT COUNT(*) FROM rooms r LEFT JOIN patients p ON p.id = r.occupied_by WHERE r.occupied AND (p.admitted_to IS NULL OR p.admitted_to != r.id)")).scalar()
+    dangling += conn.execute(_sql.text("SELECT COUNT(*) FROM patients p LEFT JOIN rooms r ON r.id = p.admitted_to WHERE p.admitted_to != 0 AND (r.occupied_by IS NULL OR r.occupied_by != p.id OR NOT r.occupied)")).scalar()
+    return double_rooms, double_pats, dangling
+
+
+def main():
+    parser = _argparse.ArgumentParser(description = "Admission and discharge contention benchmark")
+    parser.add_argument("--rooms", type = int, default = 20)
+    parser.add_argument("--patients", type = int, default = 200)
+    parser.add_argument("--threads", type = int, default = 16)
+    parser.add_argument("--seconds", type = float, default = 5.0)
+    args = parser.parse_args()
+
+    seed(args.rooms, args.patients)
+    deadline = _time.perf_counter() + args.seconds
+    totals = {"admitted" : 0, "discharged" : 0, "conflicts" : 0, "errors" : 0}
+    lock = _threading.Lock()
+
+    def worker(seed):
+        rnd = _rnd.Random(seed)
+        db = _database.SessionLocal()
+        counts = dict.fromkeys(totals, 0)
+
+        while _time.perf_counter() < deadline:
+            pat_id = rnd.randint(1, args.patients)
+            try:
+                if rnd.random() < 0.5:
+                    _services.admit_pat.sync(pat_id, rnd.randint(1, args.rooms), db)
+                    counts["admitted"] += 1
+                else:
+                    _services.discharge_pat.sync(pat_id, db)
+                    counts["discharged"] += 1
+            except _fastapi.HTTPException:
+                counts["conflicts"] += 1
+            except _sql.exc.OperationalError:
+                db.rollback()
+                counts["errors"] += 1
+
+        db.close()
+        with lock:
+            for key in totals:
+                totals[key] += counts[key]
+
+    threads = [_threading.Thread(target = worker, args = (i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with _database.engine.connect() as conn:
+        double_rooms, double_pats, dangling = check(conn)
+
+    print("database: %s, rooms: %d, patients: %d, threads: %d" % (_database.DATABASE_URL, args.rooms, args.patients, args.threads))
+    print("admissions/s: %.1f, discharges/s: %.1f, conflicts: %d, lock errors: %d" % (totals["admitted"] / args.seconds, totals["discharged"] / args.seconds, totals["conflicts"], totals["errors"]))
+    print("rooms with two patients: %d, patients in two rooms: %d, one-sided links: %d (all expected 0)" % (double_rooms, double_pats, dangling))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Cascade delete benchmark
+#
+# Deletes a doctor with many patients (some admitted, all billed) and checks nothing is left behind.
+#
+# python -m benchmarks.cascade_delete [--patients 10000] [--treatments 3] [--admitted 0.2]
+
+import argparse as _argparse
+import asyncio as _asyncio
+import os as _os
+import tempfile as _tempfile
+import time as _time
+
+_tmpdir = _tempfile.mkdtemp(prefix = "hadmdb-bench-")
+# Always a scratch database, the benchmark writes and deletes rows, a configured database is never used
+_os.environ["HADMDB_DATABASE_URL"] = "sqlite:///" + _os.path.join(_tmpdir, "bench.db")
+
+import sqlalchemy as _sql
+import database as _database, models as _models, services as _services
+
+
+# Doctor 1 gets all the patients, doctor 2 keeps one patient to check the delete stays scoped
+def seed(patients : int, treatments : int, admitted : float):
+    _services.create_database()
+    rooms = int(patients * admitted)
+
+    with _database.engine.begin() as conn:
+        conn.execute(_sql.insert(_models.Doctor), [{"name" : "Doctor 1", "spec" : "Surgeon"}, {"name" : "Doctor 2", "spec" : "Surgeon"}])
+        conn.execute(_sql.insert(_models.Room), [{"name" : "Room %d" % i, "size" : 100, "occupied" : True, "occupied_by" : i} for i in range(1, rooms + 1)])
+        conn.execute(_sql.insert(_models.Patient), [{"name" : "Patient %d" % i, "history" : "", "treated_by" : 1, "admitted_to" : i if i <= rooms else 0} for i in range(1, patients + 1)])
+        conn.execute(_sql.insert(_models.Patient), [{"name" : "Other patient", "history" : "", "treated_by" : 2, "admitted_to" : 0}])
+        conn.execute(_sql.insert(_models.Treatment), [{"name" : "Checkup", "cost" : 100, "billed_to" : 1 + i % (patients + 1)} for i in range(patients * treatments)])
+
+    return rooms
+
+
+def count(conn, stmt):
+    return conn.execute(stmt).scalar()
+
+
+def main():
+    parser = _argparse.ArgumentParser(description = "Doctor cascade delete benchmark")
+    parser.add_argument("--patients", type = int, default = 10000)
+    parser.add_argument("--treatments", type = int, default = 3)
+    parser.add_argument("--admitted", type = float, default = 0.2)
+    args = parser.parse_args()
+
+    rooms = seed(args.patients, args.treatments, args.admitted)
+    print("database: %s, patients: %d, admitted: %d, treatments: %d" % (_database.DATABASE_URL, args.patients, rooms, args.patients * args.treatments))
+
+    db = _database.SessionLocal()
+    start = _time.perf_counter()
+    _asyncio.run(_services.delete_doc(1, db))
+    elapsed = _time.perf_counter() - start
+    db.close()
+
+    with _database.engine.connect() as conn:
+        patients_left = count(conn, _sql.select(_sql.func.count()).select_from(_models.Patient))
+        rooms_occupied = count(conn, _sql.select(_sql.func.count()).select_from(_models.Room).where(_models.Room.occupied == True))
+        orphans = count(conn, _sql.select(_sql.func.count()).select_from(_models.Treatment).where(_models.Treatment.billed_to.not_in(_sql.select(_models.Patient.id))))
+
+    print("delete_doc: %.3f s" % elapsed)
+    print("patients left: %d (expected 1), rooms occupied: %d (expected 0), orphan treatments: %d (expected 0)" % (patients_left, rooms_occupied, orphans))
+
+
+if __name__ == "__main__":
+    main()
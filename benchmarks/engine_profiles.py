@@ -0,0 +1,107 @@
+# Engine profile benchmark
+#
+# Runs the same mixed read/write load against a fresh database for each sqlite
+# profile in database.PROFILES and compares throughput and lock errors.
+# Each profile runs in its own process since the engine is built at import.
+#
+# python -m benchmarks.engine_profiles [--patients 20000] [--seconds 5] [--readers 8] [--writers 2]
+
+import argparse as _argparse
+import json as _json
+import os as _os
+import random as _rnd
+import subprocess as _subprocess
+import sys as _sys
+import tempfile as _tempfile
+import threading as _threading
+import time as _time
+
+
+# Worker process: seed a database under one profile and run the load
+def run_profile(args):
+    import sqlalchemy as _sql
+    import database as _database, models as _models, schemas as _schemas, services as _services
+
+    _services.create_database()
+    with _database.engine.begin() as conn:
+        conn.execute(_sql.insert(_models.Doctor), [{"name" : "Doctor", "spec" : "Surgeon"}])
+        conn.execute(_sql.insert(_models.Patient), [{"name" : "Patient %d" % i, "history" : "", "treated_by" : 1, "admitted_to" : 0} for i in range(args.patients)])
+
+    deadline = _time.perf_counter() + args.seconds
+    counts = {"reads" : 0, "writes" : 0, "lock_errors" : 0}
+    lock = _threading.Lock()
+
+    def reader(seed):
+        rnd = _rnd.Random(seed)
+        db = _database.SessionLocal()
+        done = errors = 0
+        while _time.perf_counter() < deadline:
+            try:
+                _services.get_pat_by_id.sync(rnd.randint(1, args.patients), db)
+                db.rollback()
+                done += 1
+            except _sql.exc.OperationalError:
+                db.rollback()
+                errors += 1
+        db.close()
+        with lock:
+            counts["reads"] += done
+            counts["lock_errors"] += errors
+
+    def writer(seed):
+        rnd = _rnd.Random(seed)
+        db = _database.SessionLocal()
+        done = errors = 0
+        while _time.perf_counter() < deadline:
+            try:
+                _services.create_trt.sync(_schemas._TreatmentCreate(name = "Checkup", cost = 100, billed_to = rnd.randint(1, args.patients)), db)
+                done += 1
+            except _sql.exc.OperationalError:
+                db.rollback()
+                errors += 1
+        db.close()
+        with lock:
+            counts["writes"] += done
+            counts["lock_errors"] += errors
+
+    threads = [_threading.Thread(target = reader, args = (i,)) for i in range(args.readers)]
+    threads += [_threading.Thread(target = writer, args = (1000 + i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(_json.dumps({key : value / args.seconds if key != "lock_errors" else value for key, value in counts.items()}))
+
+
+def main():
+    parser = _argparse.ArgumentParser(description = "SQLite engine profile benchmark")
+    parser.add_argument("--patients", type = int, default = 20000)
+    parser.add_argument("--seconds", type = float, default = 5.0)
+    parser.add_argument("--readers", type = int, default = 8)
+    parser.add_argument("--writers", type = int, default = 2)
+    parser.add_argument("--profiles", nargs = "+", default = None)
+    parser.add_argument("--worker", action = "store_true", help = _argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        return run_profile(args)
+
+    import database as _database
+    profiles = args.profiles or list(_database.PROFILES)
+
+    print("patients: %d, readers: %d, writers: %d, %.0f s per profile" % (args.patients, args.readers, args.writers, args.seconds))
+    print("%12s %12s %12s %12s" % ("profile", "reads/s", "writes/s", "lock errors"))
+
+    for profile in profiles:
+        tmpdir = _tempfile.mkdtemp(prefix = "hadmdb-bench-")
+        # Reads must hit SQLite, not the entity cache
+        env = dict(_os.environ, HADMDB_DB_PROFILE = profile, HADMDB_DATABASE_URL = "sqlite:///" + _os.path.join(tmpdir, "bench.db"), HADMDB_CACHE_MODE = "off")
+        cmd = [_sys.executable, "-m", "benchmarks.engine_profiles", "--worker", "--patients", str(args.patients), "--seconds", str(args.seconds), "--readers", str(args.readers), "--writers", str(args.writers)]
+        out = _subprocess.run(cmd, env = env, check = True, capture_output = True, text = True).stdout
+        result = _json.loads(out.strip().splitlines()[-1])
+        print("%12s %12.1f %12.1f %12d" % (profile, result["reads"], result["writes"], result["lock_errors"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+# End-to-end route benchmark
+#
+# Runs the FastAPI app in-process through the test client over generated datasets of
+# growing size, and reports p50/p95/p99 latency and throughput per route group:
+# crud, search (/get/*), getall (/getall/*), billing, admission and messages.
+#
+# python -m benchmarks.routes [--scales demo 10k] [--requests 30] [--seed 0]
+#                             [--out results.json] [--baseline benchmarks/baseline.json] [--save-baseline]
+#
+# Results are written as JSON. With a baseline file present, every group's p95 is compared
+# against it and the run exits with status 1 when one is slower by more than --tolerance.
+#
+# Pages that render every patient or room (/bill/home, /admitting/{room_id}, ...) run at most
+# FULL_PAGE_REQUESTS times per scale, they take seconds each on the large scales.
+
+import argparse as _argparse
+import datetime as _dt
+import json as _json
+import os as _os
+import platform as _platform
+import random as _rnd
+import sqlite3 as _sqlite3
+import tempfile as _tempfile
+import time as _time
+
+_tmpdir = _tempfile.mkdtemp(prefix = "hadmdb-bench-")
+# Always a scratch database, the benchmark writes and deletes rows, a configured database is never used
+_os.environ["HADMDB_DATABASE_URL"] = "sqlite:///" + _os.path.join(_tmpdir, "bench.db")
+
+import sqlalchemy as _sql
+from starlette.testclient import TestClient
+import database as _database, models as _models, generator as _generator, cache as _cache
+import main as _main
+
+GROUPS = ("crud", "search", "getall", "billing", "admission", "messages")
+FULL_PAGE_REQUESTS = 5
+BASELINE = _os.path.join(_os.path.dirname(__file__), "baseline.json")
+
+
+# Grow the database to the given patient count, plus a message board of proportional size
+# (the demo scale is usually seeded by the app startup already)
+def grow(patients : int):
+    current = _scalar(_sql.select(_sql.func.count(_models.Patient.id)))
+    if patients > current:
+        _generator.generate(patients - current, seed = patients)
+
+    # One question and its reply per thread
+    rnd = _rnd.Random(patients)
+    mes_id = _max_id(_models.Message) or 0
+    now = _dt.datetime.utcnow()
+    messages = []
+    threads = []
+    for i in range(_scalar(_sql.select(_sql.func.count(_models.Message.id))) // 2, max(10, patients // 10)):
+        guest = _generator._name(rnd)
+        messages.append({"id" : mes_id + 1, "sender" : guest, "receiver" : "Admin", "subject" : "Question %d" % i, "content" : "When can I visit " + _generator._name(rnd) + "?", "date" : now, "thread_id" : mes_id + 1})
+        messages.append({"id" : mes_id + 2, "sender" : "Admin", "receiver" : guest, "subject" : "Reply to Question %d" % i, "content" : "Visiting hours are 10 to 18.", "date" : now, "parent_id" : mes_id + 1, "thread_id" : mes_id + 1})
+        threads.append({"id" : mes_id + 1, "guest" : guest, "subject" : "Question %d" % i, "last_message_id" : mes_id + 2, "last_date" : now, "messages" : 2})
+        mes_id += 2
+    _generator._insert(_database.engine, _models.Message, messages)
+    _generator._insert(_database.engine, _models.Thread, threads)
+
+    _cache.entities.clear()
+
+
+def _scalar(query):
+    with _database.engine.connect() as conn:
+        return conn.execute(query).scalar()
+
+def _max_id(model):
+    return _scalar(_sql.select(_sql.func.max(model.id)))
+
+def _free_pair():
+    room = _scalar(_sql.select(_models.Room.id).where(_models.Room.occupied == False).order_by(_sql.func.random()).limit(1))
+    pat = _scalar(_sql.select(_models.Patient.id).where(_models.Patient.admitted_to == 0).order_by(_sql.func.random()).limit(1))
+    return room, pat
+
+
+#*********************************************************
+
+# SCENARIOS
+
+#*********************************************************
+
+# Each scenario yields (route, call) pairs, only the calls are timed. Code between
+# the yields picks ids and runs untimed. full is False once the full page budget is spent.
+
+def crud(c : TestClient, rnd : _rnd.Random, full : bool):
+    doctor = rnd.randint(1, _max_id(_models.Doctor))
+
+    for table, model, form in (
+        ("doctors", _models.Doctor, {"name" : "Bench Doctor", "spec" : "Surgeon"}),
+        ("nurses", _models.Nurse, {"name" : "Bench Nurse"}),
+        ("services", _models.Service, {"name" : "Bench Personnel", "type" : "Cook"}),
+        ("rooms", _models.Room, {"name" : "Bench Room", "size" : "100"}),
+        ("patients", _models.Patient, {"name" : "Bench Patient", "history" : "None", "assigned" : str(doctor)}),
+    ):
+        yield "GET /home/" + table + "/", lambda: c.get("/home/" + table + "/")
+        yield "POST /create/" + table + "/", lambda: c.post("/create/" + table + "/", data = form)
+        created = _max_id(model)
+        key = {"doctors" : "doctor_id", "nurses" : "nurse_id", "services" : "service_id", "rooms" : "room_id", "patients" : "patient_id"}[table]
+        yield "POST /delete/" + table + "/", lambda: c.post("/delete/" + table + "/", data = {key : created})
+
+def search(c : TestClient, rnd : _rnd.Random, full : bool):
+    for table, key in (("doctors", "doctor_name"), ("nurses", "nurse_name"), ("services", "service_name"), ("rooms", "room_name"), ("patients", "patient_name")):
+        term = rnd.choice(_generator.ROOM_COLORS if table == "rooms" else _generator.LAST_NAMES)
+        yield "POST /get/" + table + "/", lambda: c.post("/get/" + table + "/", data = {key : term})
+
+def getall(c : TestClient, rnd : _rnd.Random, full : bool):
+    for table, model in (("doctors", _models.Doctor), ("nurses", _models.Nurse), ("services", _models.Service), ("rooms", _models.Room), ("patients", _models.Patient)):
+        after = rnd.randint(0, _max_id(model))
+        yield "GET /getall/" + table, lambda: c.get("/getall/" + table, params = {"after" : after})
+
+def billing(c : TestClient, rnd : _rnd.Random, full : bool):
+    pat = rnd.randint(1, _max_id(_models.Patient))
+
+    if full:
+        yield "GET /bill/home", lambda: c.get("/bill/home")
+        yield "GET /bill/check", lambda: c.get("/bill/check")
+    yield "GET /billing/{pat_id}", lambda: c.get("/billing/%d" % pat)
+    yield "POST /billing/{pat_id}", lambda: c.post("/billing/%d" % pat, data = {"name" : "Checkup", "cost" : "100"})
+    yield "GET /billcheck/{pat_id}", lambda: c.get("/billcheck/%d" % pat)
+    yield "GET /bill/report", lambda: c.get("/bill/report")
+    yield "GET /bill/report?sort=patient", lambda: c.get("/bill/report", params = {"sort" : "patient"})
+
+def admission(c : TestClient, rnd : _rnd.Random, full : bool):
+    room, pat = _free_pair()
+
+    if full:
+        yield "GET /admission/home", lambda: c.get("/admission/home")
+        yield "GET /admitting/{room_id}", lambda: c.get("/admitting/%d" % room)
+    yield "GET /admitting/{room_id}/{pat_id}", lambda: c.get("/admitting/%d/%d" % (room, pat))
+    yield "POST /admitting/{room_id}/{pat_id}", lambda: c.post("/admitting/%d/%d" % (room, pat))
+    if full:
+        yield "GET /admission/discharge", lambda: c.get("/admission/discharge")
+    yield "GET /admission/discharge/confirm/{pat_id}", lambda: c.get("/admission/discharge/confirm/%d" % pat)
+    yield "POST /admission/discharge/confirm/{pat_id}", lambda: c.post("/admission/discharge/confirm/%d" % pat)
+    yield "POST /admission/allocate", lambda: c.post("/admission/allocate", data = {"patient_id" : str(pat), "min_size" : "300"})
+    c.post("/admission/discharge/confirm/%d" % pat)
+
+def messages(c : TestClient, rnd : _rnd.Random, full : bool):
+    guest = _generator._name(rnd)
+    c.cookies.clear()
+
+    yield "POST /messageboard", lambda: c.post("/messageboard", data = {"name" : guest})
+    yield "GET /messageboard/post", lambda: c.get("/messageboard/post", params = {"subject" : "Visit", "messagecontent" : "When can I visit?"}, allow_redirects = False)
+    yield "GET /messageboard (guest)", lambda: c.get("/messageboard")
+    mes_id = _max_id(_models.Message)
+
+    c.cookies.clear()
+    yield "POST /messageboard/admin", lambda: c.post("/messageboard/admin", data = {"password" : "admin123"})
+    yield "GET /messageboard (admin)", lambda: c.get("/messageboard")
+    yield "GET /messageboard/search", lambda: c.get("/messageboard/search", params = {"q" : "visit " + guest.split()[0]})
+    yield "POST /messageboard/admin/post/...", lambda: c.post("/messageboard/admin/post/%d/%s/Visit" % (mes_id, guest), data = {"messagecontent" : "Any time."}, allow_redirects = False)
+
+SCENARIOS = {"crud" : crud, "search" : search, "getall" : getall, "billing" : billing, "admission" : admission, "messages" : messages}
+
+
+#*********************************************************
+
+# MEASUREMENT
+
+#*********************************************************
+
+# Nearest rank percentile of a sorted list
+def _percentile(values : list, q : float):
+    return values[min(len(values) - 1, max(0, int(round(q * len(values) + 0.5)) - 1))]
+
+def _summary(latencies : list, errors : int):
+    values = sorted(latencies)
+    return {
+        "requests" : len(values),
+        "errors" : errors,
+        "p50_ms" : round(_percentile(values, 0.50) * 1000, 3),
+        "p95_ms" : round(_percentile(values, 0.95) * 1000, 3),
+        "p99_ms" : round(_percentile(values, 0.99) * 1000, 3),
+    }
+
+# Status messages of pages that did what was asked, the HTML views render their errors with status 200
+OK_MESSAGES = ("Successfully ", "Are you sure ", "Discharged ")
+
+def _failed(response):
+    if response.status_code >= 400:
+        return True
+
+    message = (getattr(response, "context", None) or {}).get("statusMessage") or ""
+    empty_search = message.startswith("No ") and message.endswith(" found!")
+    return bool(message) and not message.startswith(OK_MESSAGES) and not empty_search
+
+# Run a scenario a number of times, returns the group summary with one summary per route
+# throughput_rps is requests over the wall time of the group, one client sending them back to back,
+# so it includes the untimed scenario code between the requests
+def run_group(c : TestClient, group : str, requests : int, seed : int):
+    rnd = _rnd.Random(seed)
+    routes = {}
+    group_start = _time.perf_counter()
+
+    for i in range(requests):
+        for route, call in SCENARIOS[group](c, rnd, i < FULL_PAGE_REQUESTS):
+            start = _time.perf_counter()
+            response = call()
+            elapsed = _time.perf_counter() - start
+
+            timings = routes.setdefault(route, [[], 0])
+            timings[0].append(elapsed)
+            if _failed(response):
+                timings[1] += 1
+
+    wall = _time.perf_counter() - group_start
+    latencies = [t for timings, _ in routes.values() for t in timings]
+    summary = _summary(latencies, sum(errors for _, errors in routes.values()))
+    summary["throughput_rps"] = round(len(latencies) / wall, 1) if wall else 0.0
+    summary["routes"] = {route : _summary(timings, errors) for route, (timings, errors) in routes.items()}
+    return summary
+
+
+# Groups slower than the baseline p95 by more than the tolerance, with a 1 ms floor against timer noise
+def compare(results : dict, baseline : dict, tolerance : float):
+    regressions = []
+
+    for scale, result in results["scales"].items():
+        for group, summary in result["groups"].items():
+            old = baseline.get("scales", {}).get(scale, {}).get("groups", {}).get(group)
+            if old is None:
+                continue
+
+            limit = max(old["p95_ms"] * (1 + tolerance), old["p95_ms"] + 1)
+            summary["baseline_p95_ms"] = old["p95_ms"]
+            if summary["p95_ms"] > limit:
+                regressions.append((scale, group, old["p95_ms"], summary["p95_ms"]))
+
+    return regressions
+
+
+def main():
+    parser = _argparse.ArgumentParser(description = "End-to-end latency of the routes per group")
+    parser.add_argument("--scales", nargs = "+", choices = _generator.SCALES, default = ["demo", "10k"])
+    parser.add_argument("--groups", nargs = "+", choices = GROUPS, default = list(GROUPS))
+    parser.add_argument("--requests", type = int, default = 30, help = "scenario runs per group and scale")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--out", default = "bench-routes-" + _dt.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    parser.add_argument("--baseline", default = BASELINE)
+    parser.add_argument("--save-baseline", action = "store_true", help = "write the results to the baseline file")
+    parser.add_argument("--tolerance", type = float, default = 0.25, help = "allowed p95 slowdown over the baseline")
+    args = parser.parse_args()
+
+    results = {
+        "meta" : {
+            "date" : _dt.datetime.now().isoformat(timespec = "seconds"),
+            "python" : _platform.python_version(),
+            "sqlite" : _sqlite3.sqlite_version,
+            "platform" : _platform.platform(),
+            "profile" : _database.DB_PROFILE,
+            "cache" : _cache.CACHE_MODE,
+            "requests" : args.requests,
+            "seed" : args.seed,
+        },
+        "scales" : {},
+    }
+
+    with TestClient(_main.app) as c:
+        for scale in sorted(args.scales, key = _generator.SCALES.get):
+            start = _time.perf_counter()
+            grow(_generator.SCALES[scale])
+            print("%s: %d patients generated in %.1f s" % (scale, _generator.SCALES[scale], _time.perf_counter() - start))
+
+            groups = {}
+            for group in args.groups:
+                groups[group] = run_group(c, group, args.requests, args.seed)
+            results["scales"][scale] = {"patients" : _generator.SCALES[scale], "groups" : groups}
+
+    regressions = []
+    if _os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, _json.load(f), args.tolerance)
+
+    print()
+    print("%-6s %-10s %8s %9s %9s %9s %8s %7s %12s" % ("scale", "group", "requests", "p50 ms", "p95 ms", "p99 ms", "req/s", "errors", "baseline p95"))
+    for scale, result in results["scales"].items():
+        for group, s in result["groups"].items():
+            print("%-6s %-10s %8d %9.2f %9.2f %9.2f %8.1f %7d %12s" % (scale, group, s["requests"], s["p50_ms"], s["p95_ms"], s["p99_ms"], s["throughput_rps"], s["errors"],
+                  "%.2f" % s["baseline_p95_ms"] if "baseline_p95_ms" in s else "-"))
+
+    out = args.baseline if args.save_baseline else args.out
+    with open(out, "w") as f:
+        _json.dump(results, f, indent = 2)
+    print()
+    print("results written to " + out)
+
+    if regressions:
+        print()
+        for scale, group, old, new in regressions:
+            print("REGRESSION %s/%s: p95 %.2f ms -> %.2f ms" % (scale, group, old, new))
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# Read-through entity cache for the by-id lookups
+#
+# @zgr2788
+#
+# Settings come from the environment (or the .env file loaded by database.py):
+#   HADMDB_CACHE_MODE     "local" (default), "shared" or "off"
+#   HADMDB_CACHE_SIZE     entries kept, least recently used are dropped first (default 10000)
+#   HADMDB_CACHE_TTL      seconds an entry lives (default 30)
+#   HADMDB_CACHE_FILE     generation file for shared mode (default ./cache.gen)
+#
+# local:  writes invalidate this process only, other workers see changes after at most TTL
+# shared: every write also bumps a generation in a memory mapped file shared by all workers on
+#         the host, so a write in one worker drops the row (or the table) from every cache.
+#
+# Rows share KEY_SLOTS generations per table, a write drops the few rows of its slot.
+#
+# Entries are dropped after the writing transaction commits. Every row has a generation too,
+# shared with the other rows of its slot, bumped by each write. A read that started before the
+# write loaded the old row and finds a newer generation when it is done, so it is not stored.
+
+import collections as _collections
+import zlib as _zlib
+import mmap as _mmap
+import os as _os
+import struct as _struct
+import threading as _threading
+import time as _time
+
+CACHE_MODE = _os.environ.get("HADMDB_CACHE_MODE", "local")
+CACHE_SIZE = int(_os.environ.get("HADMDB_CACHE_SIZE", 10000))
+CACHE_TTL = float(_os.environ.get("HADMDB_CACHE_TTL", 30))
+CACHE_FILE = _os.environ.get("HADMDB_CACHE_FILE", "./cache.gen")
+
+# Cached tables, the order fixes their slot in the generation file
+TABLES = ("doctors", "nurses", "services", "rooms", "patients")
+KEY_SLOTS = 4096  # Row generations per table in the generation file
+
+if CACHE_MODE not in ("local", "shared", "off"):
+    raise ValueError("Unknown HADMDB_CACHE_MODE " + CACHE_MODE + ", expected local, shared or off")
+
+_MISSING = object()
+
+
+# Generation slot of a row, stable across processes
+def _slot(key):
+    return _zlib.crc32(str(key).encode()) % KEY_SLOTS
+
+
+# 8-byte generation counters in a file every worker maps: per table one for the whole table
+# followed by KEY_SLOTS for its rows
+class _SharedGenerations:
+
+    def __init__(self, path : str):
+        size = 8 * len(TABLES) * (1 + KEY_SLOTS)
+        self._fd = _os.open(path, _os.O_RDWR | _os.O_CREAT, 0o644)
+        if _os.fstat(self._fd).st_size < size:
+            _os.ftruncate(self._fd, size)
+        self._map = _mmap.mmap(self._fd, size)
+
+    # Offset of the table counter, or of the row slot when key is given
+    def _offset(self, table : str, key = None):
+        slot = 0 if key is None else 1 + _slot(key)
+        return 8 * (TABLES.index(table) * (1 + KEY_SLOTS) + slot)
+
+    def get(self, table : str, key = None):
+        return _struct.unpack_from("<Q", self._map, self._offset(table, key))[0]
+
+    def bump(self, table : str, key = None):
+        import fcntl as _fcntl
+
+        # Serialize increments between workers
+        _fcntl.flock(self._fd, _fcntl.LOCK_EX)
+        try:
+            _struct.pack_into("<Q", self._map, self._offset(table, key), self.get(table, key) + 1)
+        finally:
+            _fcntl.flock(self._fd, _fcntl.LOCK_UN)
+
+
+class EntityCache:
+
+    def __init__(self, mode : str = CACHE_MODE, size : int = CACHE_SIZE, ttl : float = CACHE_TTL, path : str = CACHE_FILE):
+        self.mode = mode
+        self.size = size
+        self.ttl = ttl
+        self._items = _collections.OrderedDict()  # (table, id) -> (expires, generation, value)
+        self._gens = dict.fromkeys(TABLES, 0)      # Local generation per table
+        self._slots = {table : [0] * KEY_SLOTS for table in TABLES}  # Local row generations per table
+        self._shared = _SharedGenerations(path) if mode == "shared" else None
+        self._lock = _threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # Current generation of a row, entries from older generations are stale
+    def _generation(self, table : str, key):
+        local = self._gens[table], self._slots[table][_slot(key)]
+        if self._shared is None:
+            return local
+        return local + (self._shared.get(table), self._shared.get(table, key))
+
+    # Cached value or the result of load(), which is cached unless None
+    def read_through(self, table : str, key, load):
+        if self.mode == "off":
+            return load()
+
+        with self._lock:
+            generation = self._generation(table, key)
+            entry = self._items.get((table, key))
+
+            if entry is not None and entry[0] > _time.monotonic() and entry[1] == generation:
+                self._items.move_to_end((table, key))
+                self.hits += 1
+                return entry[2]
+
+            self.misses += 1
+
+        value = load()
+        if value is None:
+            return value
+
+        with self._lock:
+            # An invalidation during the load makes the value stale already
+            if self._generation(table, key) == generation:
+                self._items[(table, key)] = (_time.monotonic() + self.ttl, generation, value)
+                self._items.move_to_end((table, key))
+                while len(self._items) > self.size:
+                    self._items.popitem(last = False)
+
+        return value
+
+    # Drop one row, or the whole table when key is None
+    def invalidate(self, table : str, key = None):
+        if self.mode == "off":
+            return
+
+        with self._lock:
+            self.invalidations += 1
+            if key is None:
+                self._gens[table] += 1
+            else:
+                self._slots[table][_slot(key)] += 1
+                self._items.pop((table, key), None)
+
+        if self._shared is not None:
+            self._shared.bump(table, key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            for table in TABLES:
+                self._gens[table] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "mode" : self.mode,
+                "entries" : len(self._items),
+                "max_entries" : self.size,
+                "ttl" : self.ttl,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "hit_ratio" : self.hits / lookups if lookups else 0.0,
+                "invalidations" : self.invalidations,
+            }
+
+
+entities = EntityCache()
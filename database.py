@@ -1,18 +1,87 @@
 # Database initializer
-# 
+#
 # @zgr2788
+#
+# Engine settings come from the environment or a .env file:
+#   HADMDB_DATABASE_URL   database url, defaults to sqlite:///./database.db
+#   HADMDB_DB_PROFILE     sqlite pragma profile, one of PROFILES (default "wal")
+#   HADMDB_PRAGMAS        extra pragmas over the profile, e.g. "synchronous=FULL,cache_size=-20000"
+#   HADMDB_POOL_SIZE      pooled connections kept open (default 10)
+#   HADMDB_MAX_OVERFLOW   connections opened past the pool under load (default 10)
 
 
 
+import os as _os
+import dotenv as _dotenv
 import sqlalchemy as _sql
 import sqlalchemy.ext.declarative as _declarative
 import sqlalchemy.orm as _orm
 
-DATABASE_URL = "sqlite:///./database.db"
+_dotenv.load_dotenv()
 
-engine = _sql.create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+DATABASE_URL = _os.environ.get("HADMDB_DATABASE_URL", "sqlite:///./database.db")
+
+# SQLite pragma profiles, applied on every new connection
+PROFILES = {
+    # SQLite defaults: rollback journal, readers block behind writers, fsync on every commit
+    "legacy" : {},
+
+    # WAL: readers never block on the writer, fsync only at checkpoints
+    "wal" : {
+        "journal_mode" : "WAL",
+        "synchronous" : "NORMAL",
+        "cache_size" : -65536,      # 64 MB page cache
+        "mmap_size" : 268435456,    # 256 MB memory mapped reads
+        "busy_timeout" : 5000,      # Wait up to 5 s for the write lock instead of "database is locked"
+        "temp_store" : "MEMORY",
+    },
+
+    # WAL with an fsync on every commit, for deployments that can not lose the last commits on power loss
+    "wal_durable" : {
+        "journal_mode" : "WAL",
+        "synchronous" : "FULL",
+        "cache_size" : -65536,
+        "mmap_size" : 268435456,
+        "busy_timeout" : 5000,
+        "temp_store" : "MEMORY",
+    },
+}
+
+DB_PROFILE = _os.environ.get("HADMDB_DB_PROFILE", "wal")
+POOL_SIZE = int(_os.environ.get("HADMDB_POOL_SIZE", 10))
+MAX_OVERFLOW = int(_os.environ.get("HADMDB_MAX_OVERFLOW", 10))
+
+if DB_PROFILE not in PROFILES:
+    raise ValueError("Unknown HADMDB_DB_PROFILE " + DB_PROFILE + ", expected one of " + ", ".join(PROFILES))
+
+# Profile pragmas with the HADMDB_PRAGMAS overrides on top
+PRAGMAS = dict(PROFILES[DB_PROFILE])
+for item in filter(None, _os.environ.get("HADMDB_PRAGMAS", "").split(",")):
+    key, value = item.split("=", 1)
+    PRAGMAS[key.strip()] = value.strip()
+
+_url = _sql.engine.make_url(DATABASE_URL)
+
+if _url.get_backend_name() == "sqlite":
+    _engine_args = {"connect_args" : {"check_same_thread" : False}}
+
+    # File databases keep a pool of open connections, so pragmas and page cache survive between requests
+    if _url.database and _url.database != ":memory:":
+        _engine_args.update(poolclass = _sql.pool.QueuePool, pool_size = POOL_SIZE, max_overflow = MAX_OVERFLOW)
+else:
+    _engine_args = {"pool_size" : POOL_SIZE, "max_overflow" : MAX_OVERFLOW}
+
+engine = _sql.create_engine(DATABASE_URL, **_engine_args)
+
+# Apply the pragmas on connect
+if engine.dialect.name == "sqlite":
+    @_sql.event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        for key, value in PRAGMAS.items():
+            cursor.execute("PRAGMA " + key + " = " + str(value))
+        cursor.close()
 
 SessionLocal = _orm.sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = _declarative.declarative_base()
-
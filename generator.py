@@ -0,0 +1,143 @@
+# Synthetic hospital generator for demos, benchmarks and load tests
+#
+# @zgr2788
+#
+# Deterministic for a given seed and scale. Rows are written with core executemany
+# inserts in chunks, one transaction per chunk, and appended after any existing rows.
+#
+# HADMDB_DATABASE_URL=sqlite:///./big.db python -m generator --patients 100000 --seed 42
+#
+# Per patient count P: P/50 doctors, P/25 nurses, P/100 personnel (at least 5 each), P/10 rooms
+# (at least 10, 75% occupied) and 0-6 treatments per patient (3 on average)
+
+import argparse as _argparse
+import random as _rnd
+import time as _time
+import sqlalchemy as _sql
+import database as _database
+import models as _models
+
+CHUNK = 20000  # Rows per insert transaction
+
+# Preset scales for --scale
+SCALES = {
+    "demo" : 50,
+    "10k" : 10000,
+    "100k" : 100000,
+    "1m" : 1000000,
+}
+
+FIRST_NAMES = ["Thomas", "Arthur", "John", "Ragnar", "Bjorn", "Miles", "Michelle", "Ayse", "Mehmet", "Elif", "Can", "Zeynep", "Emre", "Deniz", "Selin",
+               "Mustafa", "Fatma", "Ali", "Hatice", "Burak", "Ece", "Murat", "Seda", "Kerem", "Ipek", "Walter", "Jesse", "Clara", "Dorothea", "Florence"]
+LAST_NAMES = ["Shelby", "Lothbrok", "Morales", "Obama", "Yilmaz", "Kaya", "Demir", "Sahin", "Celik", "Yildiz", "Aydin", "Ozturk", "Arslan", "Dogan",
+              "Kilic", "Aslan", "Cetin", "Kara", "Koc", "Kurt", "Ozdemir", "Simsek", "Polat", "White", "Pinkman", "Barton", "Dix", "Nightingale"]
+SPECS = ["Heart Surgeon", "ENT Specialist", "Ophthalmologist", "Dermatologist", "Urologist", "Neurologist", "Pediatrician", "Oncologist",
+         "Orthopedist", "Radiologist", "Anesthesiologist", "General Surgeon"]
+SERVICE_TYPES = ["Cook", "Security Specialist", "Legal Advisor", "Financial Advisor", "Cleaner", "Receptionist", "Technician", "Driver"]
+ROOM_COLORS = ["White", "Blue", "Red", "Pink", "Purple", "Orange", "Black", "Green", "Yellow", "Grey"]
+HISTORIES = ["Heart Attack", "Nosebleed", "Astigmatism + Myopia", "Vitiligo", "Runny Nose", "Eczema", "Broken Arm", "Migraine", "Appendicitis",
+             "Pneumonia", "Diabetes", "Hypertension", "Asthma", "Kidney Stones", "Concussion"]
+TREATMENTS = [("Checkup", 50, 200), ("Blood Test", 30, 120), ("X-Ray", 100, 400), ("MRI", 800, 2500), ("Surgery", 5000, 40000),
+              ("Physiotherapy", 150, 600), ("Prescription", 20, 300), ("Night Stay", 400, 1200)]
+
+
+def _name(rnd : _rnd.Random):
+    return rnd.choice(FIRST_NAMES) + " " + rnd.choice(LAST_NAMES)
+
+# Insert rows from an iterator in chunks
+def _insert(engine, model, rows):
+    count = 0
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK:
+            with engine.begin() as conn:
+                conn.execute(_sql.insert(model), chunk)
+            count += len(chunk)
+            chunk = []
+
+    if chunk:
+        with engine.begin() as conn:
+            conn.execute(_sql.insert(model), chunk)
+        count += len(chunk)
+
+    return count
+
+# Largest id of a table, new rows go after it
+def _max_id(engine, model):
+    with engine.connect() as conn:
+        return conn.execute(_sql.select(_sql.func.coalesce(_sql.func.max(model.id), 0))).scalar()
+
+
+# Generate a hospital with the given number of patients, returns the row counts per table
+def generate(patients : int, seed : int = 0, engine = None):
+    engine = engine or _database.engine
+    rnd = _rnd.Random(seed)
+
+    doctors = max(5, patients // 50)
+    nurses = max(5, patients // 25)
+    services = max(5, patients // 100)
+    rooms = max(10, patients // 10)
+    admitted = min(patients, int(rooms * 0.75))
+
+    doc_base = _max_id(engine, _models.Doctor)
+    ro_base = _max_id(engine, _models.Room)
+    pat_base = _max_id(engine, _models.Patient)
+
+    # Occupied rooms and their patients, both picked without repeats
+    occupied = dict(zip(rnd.sample(range(1, rooms + 1), admitted), rnd.sample(range(1, patients + 1), admitted)))
+    admitted_to = {pat : ro for ro, pat in occupied.items()}
+
+    counts = {}
+    counts["doctors"] = _insert(engine, _models.Doctor, ({"id" : doc_base + i, "name" : _name(rnd), "spec" : rnd.choice(SPECS)} for i in range(1, doctors + 1)))
+    counts["nurses"] = _insert(engine, _models.Nurse, ({"name" : _name(rnd)} for _ in range(nurses)))
+    counts["services"] = _insert(engine, _models.Service, ({"name" : _name(rnd), "type" : rnd.choice(SERVICE_TYPES)} for _ in range(services)))
+    counts["rooms"] = _insert(engine, _models.Room, ({
+        "id" : ro_base + i,
+        "name" : rnd.choice(ROOM_COLORS) + " Room " + str(ro_base + i),
+        "size" : rnd.randrange(100, 600, 10),
+        "occupied" : i in occupied,
+        "occupied_by" : pat_base + occupied[i] if i in occupied else 0,
+    } for i in range(1, rooms + 1)))
+    counts["patients"] = _insert(engine, _models.Patient, ({
+        "id" : pat_base + i,
+        "name" : _name(rnd),
+        "history" : rnd.choice(HISTORIES),
+        "treated_by" : doc_base + rnd.randint(1, doctors),
+        "admitted_to" : ro_base + admitted_to[i] if i in admitted_to else 0,
+    } for i in range(1, patients + 1)))
+
+    def treatments():
+        for i in range(1, patients + 1):
+            for _ in range(rnd.randint(0, 6)):
+                name, low, high = rnd.choice(TREATMENTS)
+                yield {"name" : name, "cost" : rnd.randint(low, high), "billed_to" : pat_base + i}
+
+    counts["treatments"] = _insert(engine, _models.Treatment, treatments())
+    return counts
+
+
+def main():
+    parser = _argparse.ArgumentParser(description = "Generate a synthetic hospital")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--patients", type = int)
+    group.add_argument("--scale", choices = SCALES, default = "10k")
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args()
+
+    import services as _services
+    _services.create_database()
+
+    patients = args.patients if args.patients is not None else SCALES[args.scale]
+    start = _time.perf_counter()
+    counts = generate(patients, seed = args.seed)
+
+    print("database: %s, seed: %d" % (_database.DATABASE_URL, args.seed))
+    for table, count in counts.items():
+        print("%12s %10d" % (table, count))
+    print("done in %.1f s" % (_time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
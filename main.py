@@ -6,8 +6,10 @@ import fastapi as _fastapi
 from typing import Union
 import fastapi.templating as _templates
 import fastapi.staticfiles as _StaticFiles
+import fastapi.responses as _responses
 import sqlalchemy.orm as _orm
-import services as _services, schemas as _schemas, models as _models, database as _database
+import services as _services, schemas as _schemas, models as _models, database as _database, api as _api, metrics as _metrics, slowlog as _slowlog, push as _push
+import asyncio as _asyncio
 import jinja2 as _jinja2
 import fastapi.security as _security
 import jwt as _jwt
@@ -22,26 +24,82 @@ to_zone = _tz.gettz('Turkey')
 
 app = _fastapi.FastAPI()
 
-_services.create_database()
-
-# NoSQL Database initialized here
-message_id = 1
-message_db = {}
-
 app.mount("/static", _StaticFiles.StaticFiles(directory="static"), name="static")
+app.include_router(_api.router)
 
 templates = _templates.Jinja2Templates(directory = "templates")
+
+# Request latency, SQL and template render time, served on /metrics
+if _metrics.METRICS_ENABLED:
+    _metrics.instrument_engine(_database.engine)
+    _metrics.instrument_templates(templates.env)
+    app.add_middleware(_metrics.MetricsMiddleware)
+
+_slowlog.instrument_engine(_database.engine)
+
 JWT_SECRET_ADMIN = 'ADMINSECRETHADMDB'
 adminJWT = {'name' : 'admin', 'password' : 'admin123'} # standard admin password
+STREAM_BUFFER = 64  # Template pieces joined per streamed chunk
+
+# Render a template as a stream of chunks, so iterators in the context are consumed lazily
+# Starlette pulls sync iterators in its thread pool, keeping the event loop free
+def stream_template(name : str, context : dict):
+    stream = templates.get_template(name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER)
+    return _responses.StreamingResponse(stream, media_type = "text/html")
 
-# On startup, add random data for the database
+# On startup, create or migrate the schema and add random data to an empty database
 @app.on_event("startup")
 async def startup():
-    
-    # If database is empty
-    if await _services.get_docs(_database.SessionLocal()) == []:
-        await _services.insert_dummy_data(_database.SessionLocal())
-    return 0
+    await _services.init_database()
+
+    # Pick up messages stored by other workers for the live message board
+    if _push.PUSH_POLL > 0:
+        with _database.SessionLocal() as db:
+            last_id = await _services.get_last_msg_id(db)
+        app.state.push_poller = _asyncio.create_task(_push.hub.poll(_new_msgs, last_id))
+
+    # Message retention
+    if _services.MESSAGE_MAX_AGE_DAYS > 0 or _services.MESSAGE_MAX_PER_GUEST > 0:
+        app.state.compactor = _asyncio.create_task(_compact_msgs())
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in ("push_poller", "compactor"):
+        if getattr(app.state, task, None) is not None:
+            getattr(app.state, task).cancel()
+
+async def _compact_msgs():
+    while True:
+        try:
+            with _database.SessionLocal() as db:
+                await _services.compact_msgs(db)
+        except Exception:
+            # A busy database skips this run, the next one catches up
+            pass
+        await _asyncio.sleep(_services.COMPACT_INTERVAL)
+
+async def _new_msgs(after_id : int):
+    with _database.SessionLocal() as db:
+        return await _services.get_msgs_after(after_id, db)
+
+# Prometheus metrics of this worker
+@app.get("/metrics")
+async def metrics():
+    if not _metrics.METRICS_ENABLED:
+        raise _fastapi.HTTPException(status_code=404, detail = "Metrics are disabled!")
+    return _responses.PlainTextResponse(_metrics.expose(), media_type = "text/plain; version=0.0.4")
+
+# Latest slow statements of this worker with their query plans - Admin, parameters hold patient data
+@app.get("/debug/slow-queries")
+async def slow_queries(request: _fastapi.Request, full_scans : bool = False, account_type: Union[str, None] = _fastapi.Cookie(default=None)):
+    if account_type != "Admin":
+        return _fastapi.responses.RedirectResponse("/messageboard")
+
+    entries = _slowlog.recent()
+    if full_scans:
+        entries = [entry for entry in entries if entry["full_scan"]]
+    return templates.TemplateResponse('slow_queries.html', context = {'request' : request, 'entries' : entries, 'full_scans' : full_scans, 'threshold' : _slowlog.SLOW_QUERY_MS})
 
 # Main page
 @app.get("/")
@@ -106,26 +164,28 @@ async def get_doctors_by_name(request: _fastapi.Request):
     return templates.TemplateResponse('doctor_selection.html', context = {'request': request, 'statusMessage': statusMessage})
 
 @app.post("/get/doctors/", status_code = 200)
-async def get_doctors_by_name(request: _fastapi.Request, doctor_name : str = _fastapi.Form(), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+async def get_doctors_by_name(request: _fastapi.Request, doctor_name : str = _fastapi.Form(), after : int = _fastapi.Form(0), db: _orm.Session = _fastapi.Depends(_services.get_db)):
     statusMessage = ""
 
-    # Wildcard search
+    # Wildcard search, the paged listing
     if doctor_name == "*":
-        doc_list = await _services.get_docs(db=db)
-        return templates.TemplateResponse('doctor_selection.html', context = {'request': request, 'docs_list': doc_list, 'statusMessage' : statusMessage})
+        return _fastapi.responses.RedirectResponse("/getall/doctors", status_code = 303)
 
-    doc_list = await _services.get_docs_by_name(doc_name = doctor_name, db = db)
+    try:
+        doc_list, next_cursor = await _services.get_docs_by_name(doc_name = doctor_name, db = db, after_id = after)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('doctor_selection.html', context = {'request': request, 'statusMessage' : e.detail})
 
     if not doc_list:
         statusMessage = "No doctors found!"
 
-    return templates.TemplateResponse('doctor_selection.html', context = {'request': request, 'docs_list': doc_list, 'statusMessage' : statusMessage})
+    return templates.TemplateResponse('doctor_selection.html', context = {'request': request, 'docs_list': doc_list, 'statusMessage' : statusMessage, 'term' : doctor_name, 'next_cursor' : next_cursor})
 
 # Get all doctors - debug
 @app.get("/getall/doctors", status_code = 200)
-async def get_all_doctors(request: _fastapi.Request, db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    docs_list = await _services.get_docs(db = db)
-    return templates.TemplateResponse('doctor_display.html', context = {'request' : request, 'docs_list' : docs_list})
+async def get_all_doctors(request: _fastapi.Request, after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    docs_list, next_cursor = await _services.get_docs_page(db = db, after_id = after, limit = limit)
+    return templates.TemplateResponse('doctor_display.html', context = {'request' : request, 'docs_list' : docs_list, 'after' : after, 'limit' : limit, 'next_cursor' : next_cursor})
 
 
 #*********************************************************
@@ -180,26 +240,28 @@ async def get_nurses_by_name(request: _fastapi.Request):
     return templates.TemplateResponse('nurse_selection.html', context = {'request': request, 'statusMessage': statusMessage})
 
 @app.post("/get/nurses/", status_code = 200)
-async def get_nurses_by_name(request: _fastapi.Request, nurse_name : str = _fastapi.Form(), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+async def get_nurses_by_name(request: _fastapi.Request, nurse_name : str = _fastapi.Form(), after : int = _fastapi.Form(0), db: _orm.Session = _fastapi.Depends(_services.get_db)):
     statusMessage = ""
 
-    # Wildcard search
+    # Wildcard search, the paged listing
     if nurse_name == "*":
-        nurse_list = await _services.get_nurses(db=db)
-        return templates.TemplateResponse('nurse_selection.html', context = {'request': request, 'docs_list': nurse_list, 'statusMessage' : statusMessage})
+        return _fastapi.responses.RedirectResponse("/getall/nurses", status_code = 303)
 
-    nurse_list = await _services.get_nurs_by_name(nur_name = nurse_name, db = db)
+    try:
+        nurse_list, next_cursor = await _services.get_nurs_by_name(nur_name = nurse_name, db = db, after_id = after)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('nurse_selection.html', context = {'request': request, 'statusMessage' : e.detail})
 
     if not nurse_list:
         statusMessage = "No nurses found!"
 
-    return templates.TemplateResponse('nurse_selection.html', context = {'request': request, 'docs_list': nurse_list, 'statusMessage' : statusMessage})
+    return templates.TemplateResponse('nurse_selection.html', context = {'request': request, 'docs_list': nurse_list, 'statusMessage' : statusMessage, 'term' : nurse_name, 'next_cursor' : next_cursor})
 
 # Get all doctors - debug
 @app.get("/getall/nurses", status_code = 200)
-async def get_all_nurses(request: _fastapi.Request, db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    nurs_list = await _services.get_nurses(db = db)
-    return templates.TemplateResponse('nurse_display.html', context = {'request' : request, 'docs_list' : nurs_list})
+async def get_all_nurses(request: _fastapi.Request, after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    nurs_list, next_cursor = await _services.get_nurses_page(db = db, after_id = after, limit = limit)
+    return templates.TemplateResponse('nurse_display.html', context = {'request' : request, 'docs_list' : nurs_list, 'after' : after, 'limit' : limit, 'next_cursor' : next_cursor})
 
 
 #*********************************************************
@@ -255,26 +317,28 @@ async def get_services_by_name(request: _fastapi.Request):
     return templates.TemplateResponse('service_selection.html', context = {'request': request, 'statusMessage': statusMessage})
 
 @app.post("/get/services/", status_code = 200)
-async def get_services_by_name(request: _fastapi.Request, service_name : str = _fastapi.Form(), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+async def get_services_by_name(request: _fastapi.Request, service_name : str = _fastapi.Form(), after : int = _fastapi.Form(0), db: _orm.Session = _fastapi.Depends(_services.get_db)):
     statusMessage = ""
 
-    # Wildcard search
+    # Wildcard search, the paged listing
     if service_name == "*":
-        service_list = await _services.get_sers(db=db)
-        return templates.TemplateResponse('service_selection.html', context = {'request': request, 'docs_list': service_list, 'statusMessage' : statusMessage})
+        return _fastapi.responses.RedirectResponse("/getall/services", status_code = 303)
 
-    service_list = await _services.get_sers_by_name(ser_name = service_name, db = db)
+    try:
+        service_list, next_cursor = await _services.get_sers_by_name(ser_name = service_name, db = db, after_id = after)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('service_selection.html', context = {'request': request, 'statusMessage' : e.detail})
 
     if not service_list:
         statusMessage = "No personnel found!"
 
-    return templates.TemplateResponse('service_selection.html', context = {'request': request, 'docs_list': service_list, 'statusMessage' : statusMessage})
+    return templates.TemplateResponse('service_selection.html', context = {'request': request, 'docs_list': service_list, 'statusMessage' : statusMessage, 'term' : service_name, 'next_cursor' : next_cursor})
 
 # Get all services - debug
 @app.get("/getall/services", status_code = 200)
-async def get_all_services(request: _fastapi.Request, db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    sers_list = await _services.get_sers(db = db)
-    return templates.TemplateResponse('service_display.html', context = {'request' : request, 'docs_list' : sers_list})
+async def get_all_services(request: _fastapi.Request, after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    sers_list, next_cursor = await _services.get_sers_page(db = db, after_id = after, limit = limit)
+    return templates.TemplateResponse('service_display.html', context = {'request' : request, 'docs_list' : sers_list, 'after' : after, 'limit' : limit, 'next_cursor' : next_cursor})
 
 
 #*********************************************************
@@ -336,26 +400,28 @@ async def get_rooms_by_name(request: _fastapi.Request):
     return templates.TemplateResponse('room_selection.html', context = {'request': request, 'statusMessage': statusMessage})
 
 @app.post("/get/rooms/", status_code = 200)
-async def get_rooms_by_name(request: _fastapi.Request, room_name : str = _fastapi.Form(), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+async def get_rooms_by_name(request: _fastapi.Request, room_name : str = _fastapi.Form(), after : int = _fastapi.Form(0), db: _orm.Session = _fastapi.Depends(_services.get_db)):
     statusMessage = ""
 
-    # Wildcard search
+    # Wildcard search, the paged listing
     if room_name == "*":
-        room_list = await _services.get_ros(db=db)
-        return templates.TemplateResponse('room_selection.html', context = {'request': request, 'docs_list': room_list, 'statusMessage' : statusMessage})
+        return _fastapi.responses.RedirectResponse("/getall/rooms", status_code = 303)
 
-    room_list = await _services.get_ros_by_name(ro_name = room_name, db = db)
+    try:
+        room_list, next_cursor = await _services.get_ros_by_name(ro_name = room_name, db = db, after_id = after)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('room_selection.html', context = {'request': request, 'statusMessage' : e.detail})
 
     if not room_list:
         statusMessage = "No room found!"
 
-    return templates.TemplateResponse('room_selection.html', context = {'request': request, 'docs_list': room_list, 'statusMessage' : statusMessage})
+    return templates.TemplateResponse('room_selection.html', context = {'request': request, 'docs_list': room_list, 'statusMessage' : statusMessage, 'term' : room_name, 'next_cursor' : next_cursor})
 
 # Get all rooms - debug
 @app.get("/getall/rooms", status_code = 200)
-async def get_all_rooms(request: _fastapi.Request, db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    ros_list = await _services.get_ros(db = db)
-    return templates.TemplateResponse('room_display.html', context = {'request' : request, 'docs_list' : ros_list})
+async def get_all_rooms(request: _fastapi.Request, after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    ros_list, next_cursor = await _services.get_ros_page(db = db, after_id = after, limit = limit)
+    return templates.TemplateResponse('room_display.html', context = {'request' : request, 'docs_list' : ros_list, 'after' : after, 'limit' : limit, 'next_cursor' : next_cursor})
 
 
 
@@ -426,26 +492,28 @@ async def get_patients_by_name(request: _fastapi.Request):
     return templates.TemplateResponse('patient_selection.html', context = {'request': request, 'statusMessage': statusMessage})
 
 @app.post("/get/patients/", status_code = 200)
-async def get_patients_by_name(request: _fastapi.Request, patient_name : str = _fastapi.Form(), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+async def get_patients_by_name(request: _fastapi.Request, patient_name : str = _fastapi.Form(), after : int = _fastapi.Form(0), db: _orm.Session = _fastapi.Depends(_services.get_db)):
     statusMessage = ""
 
-    # Wildcard search
+    # Wildcard search, the paged listing
     if patient_name == "*":
-        patient_list = await _services.get_pats(db=db)
-        return templates.TemplateResponse('patient_selection.html', context = {'request': request, 'docs_list': patient_list, 'statusMessage' : statusMessage})
+        return _fastapi.responses.RedirectResponse("/getall/patients", status_code = 303)
 
-    patient_list = await _services.get_pats_by_name(pat_name = patient_name, db = db)
+    try:
+        patient_list, next_cursor = await _services.get_pats_by_name(pat_name = patient_name, db = db, after_id = after)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('patient_selection.html', context = {'request': request, 'statusMessage' : e.detail})
 
     if not patient_list:
         statusMessage = "No patients found!"
 
-    return templates.TemplateResponse('patient_selection.html', context = {'request': request, 'docs_list': patient_list, 'statusMessage' : statusMessage})
+    return templates.TemplateResponse('patient_selection.html', context = {'request': request, 'docs_list': patient_list, 'statusMessage' : statusMessage, 'term' : patient_name, 'next_cursor' : next_cursor})
 
 # Get all rooms - debug
 @app.get("/getall/patients", status_code = 200)
-async def get_all_patients(request: _fastapi.Request, db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    pats_list = await _services.get_pats(db = db)
-    return templates.TemplateResponse('patient_display.html', context = {'request' : request, 'docs_list' : pats_list})
+async def get_all_patients(request: _fastapi.Request, after : int = 0, limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    pats_list, next_cursor = await _services.get_pats_page(db = db, after_id = after, limit = limit)
+    return templates.TemplateResponse('patient_display.html', context = {'request' : request, 'docs_list' : pats_list, 'after' : after, 'limit' : limit, 'next_cursor' : next_cursor})
 
 
 
@@ -461,8 +529,8 @@ async def get_all_patients(request: _fastapi.Request, db: _orm.Session = _fastap
 # Get bill home
 @app.get("/bill/home")
 async def home_billing(request: _fastapi.Request,  db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    pats_list = await _services.get_pats(db = db)
-    return templates.TemplateResponse('bill_treatments.html', context = {'request' : request, 'patients_list' : pats_list})
+    pats_list = _services.iter_pats(db = db)
+    return stream_template('bill_treatments.html', context = {'request' : request, 'patients_list' : pats_list})
 
 # Get bill for patient
 @app.get("/billing/{pat_id}")
@@ -484,17 +552,14 @@ async def bill_patient(request: _fastapi.Request, pat_id: int, name : str =  _fa
     
 
     pat_db = await _services.get_pat_by_id(pat_id, db)
-    pat_id = pat_db.id
 
-    trt = _models.Treatment(
+    trt = _schemas._TreatmentCreate(
         name = name,
-        cost = cost,
-        billed_to = pat_id
+        cost = costNum,
+        billed_to = pat_db.id
     )
 
-    db.add(trt)
-    db.commit()
-    db.refresh(trt)
+    await _services.create_trt(trt, db)
 
     statusMessage = "Successfully billed treatment " + str(name) + " to patient " + str(pat_db.name) + "."
 
@@ -503,20 +568,35 @@ async def bill_patient(request: _fastapi.Request, pat_id: int, name : str =  _fa
 # Get bill check
 @app.get("/bill/check")
 async def home_billing(request: _fastapi.Request,  db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    pats_list = await _services.get_pats(db = db)
-    return templates.TemplateResponse('check_bills.html', context = {'request' : request, 'patients_list' : pats_list})
+    pats_list = _services.iter_pats(db = db)
+    return stream_template('check_bills.html', context = {'request' : request, 'patients_list' : pats_list})
 
 
 # Get bills list for patient
 @app.get("/billcheck/{pat_id}")
 async def check_patient(request: _fastapi.Request, pat_id: int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    pat_db = await _services.get_pat_by_id(pat_id, db)
-    bills_list = db.query(_models.Treatment).filter(_models.Treatment.billed_to == pat_id).all()
+    bills = await _services.get_pat_bills(pat_id, db)
+    if bills is None:
+        raise _fastapi.HTTPException(status_code=404, detail = "Patient ID not found in database!")
+
+    pat_db, bills_list, total, _ = bills
     name = pat_db.name
     id = pat_db.id
-    total = sum([trt.cost for trt in bills_list])
     return templates.TemplateResponse('bills_table_patient.html', context = {'request' : request, 'patient_id' : id, 'patient_name' : name, 'pat_treat_list' : bills_list, 'total' : total})
 
+# Billing report, totals for all patients
+@app.get("/bill/report")
+async def bill_report(request: _fastapi.Request, sort : str = "amount", after : str = "", limit : int = _services.PAGE_SIZE, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if sort not in _services.BILL_REPORT_SORTS:
+        raise _fastapi.HTTPException(status_code=400, detail = "Sort must be one of " + ", ".join(_services.BILL_REPORT_SORTS) + "!")
+
+    try:
+        report, next_cursor = await _services.get_bill_report(db, sort = sort, after = after, limit = limit)
+    except ValueError:
+        raise _fastapi.HTTPException(status_code=400, detail = "Invalid cursor!")
+
+    return templates.TemplateResponse('bill_report.html', context = {'request' : request, 'report' : report, 'sort' : sort, 'after' : after, 'limit' : limit, 'next_cursor' : next_cursor})
+
 
 
 #*********************************************************
@@ -528,24 +608,27 @@ async def check_patient(request: _fastapi.Request, pat_id: int, db: _orm.Session
 # Get Admission Home
 @app.get("/admission/home")
 async def home_room_admit(request: _fastapi.Request,  db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    rooms_list = await _services.get_ros(db = db)
-    return templates.TemplateResponse('admit_rooms.html', context = {'request' : request, 'rooms_list' : rooms_list})
+    rooms_list = _services.iter_ros(db = db)
+    return stream_template('admit_rooms.html', context = {'request' : request, 'rooms_list' : rooms_list})
 
 # Get admit for room
 @app.get("/admitting/{room_id}")
 async def admit_patient(request: _fastapi.Request, room_id: int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
     ro_db = await _services.get_ro_by_id(room_id, db)
-    pats_list = await _services.get_pats(db)
+    pats_list = _services.iter_pats(db)
     name = ro_db.name
     id = ro_db.id
     statusMessage = ""
-    return templates.TemplateResponse('admitting_patient.html', context = {'request' : request, 'room_id' : room_id, 'patients_list' : pats_list, 'room_name' : name, 'statusMessage' : statusMessage})
+    return stream_template('admitting_patient.html', context = {'request' : request, 'room_id' : room_id, 'patients_list' : pats_list, 'room_name' : name, 'statusMessage' : statusMessage})
 
 # Get admit confirmation
 @app.get("/admitting/{room_id}/{pat_id}")
 async def admitting_patient(request: _fastapi.Request, room_id: int, pat_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    pat_db = await _services.get_pat_by_id(pat_id, db)
-    room_db = await _services.get_ro_by_id(room_id, db)
+    try:
+        pat_db, room_db = await _services.get_pat_and_ro(pat_id, room_id, db)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('admitting_areyousure.html', context = {'request' : request, 'statusMessage' : e.detail})
+
     statusMessage = "Are you sure you want to admit " + pat_db.name + " to " + room_db.name + "?"
     return templates.TemplateResponse('admitting_areyousure.html', context = {'request' : request, 'room_id' : room_id, 'pat_id' : pat_id, 'room_name' : room_db.name, 'pat_name' : pat_db.name, 'statusMessage' : statusMessage})
 
@@ -553,19 +636,29 @@ async def admitting_patient(request: _fastapi.Request, room_id: int, pat_id : in
 @app.post("/admitting/{room_id}/{pat_id}")
 async def admitted_patient(request: _fastapi.Request, room_id: int, pat_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
     
-    # Get pat and room
-    pat_db = await _services.get_pat_by_id(pat_id, db)
-    room_db = await _services.get_ro_by_id(room_id, db)
-
     # Admit and connect both
-    pat_db.admitted_to = room_db.id
-    room_db.occupied_by = pat_db.id
-    room_db.occupied = True
+    try:
+        pat_db, room_db = await _services.admit_pat(pat_id, room_id, db)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('admitting_areyousure.html', context = {'request' : request, 'statusMessage' : e.detail})
 
+    statusMessage = "Successfully admitted " + pat_db.name + " to " + room_db.name + "!"
+    return templates.TemplateResponse('admitting_areyousure.html', context = {'request' : request, 'statusMessage' : statusMessage})
+
+# Admit patient to the best fitting free room, one round trip
+@app.post("/admission/allocate")
+async def allocate_room(request: _fastapi.Request, patient_id : str = _fastapi.Form(), min_size : str = _fastapi.Form(), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    try :
+        pat_id = int(patient_id)
+        size = int(min_size)
+    except :
+        statusMessage = "Please enter numeric values for patient ID and room size!"
+        return templates.TemplateResponse('admitting_areyousure.html', context = {'request' : request, 'statusMessage' : statusMessage})
 
-    db.commit()
-    db.refresh(pat_db)
-    db.refresh(room_db)
+    try:
+        pat_db, room_db = await _services.allocate_ro(pat_id, size, db)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('admitting_areyousure.html', context = {'request' : request, 'statusMessage' : e.detail})
 
     statusMessage = "Successfully admitted " + pat_db.name + " to " + room_db.name + "!"
     return templates.TemplateResponse('admitting_areyousure.html', context = {'request' : request, 'statusMessage' : statusMessage})
@@ -573,20 +666,18 @@ async def admitted_patient(request: _fastapi.Request, room_id: int, pat_id : int
 # Get Discharge Home
 @app.get("/admission/discharge")
 async def home_discharge(request: _fastapi.Request,  db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    pats_list = await _services.get_pats(db = db)
-    
-    admitted_pats = []
-    for pat in pats_list:
-        if pat.admitted_to != 0:
-            admitted_pats.append(pat)
-    
-    return templates.TemplateResponse('discharge_rooms.html', context = {'request' : request, 'pats_list' : admitted_pats})
+    admitted_pats = _services.iter_pats(db = db, admitted = True)
+    return stream_template('discharge_rooms.html', context = {'request' : request, 'pats_list' : admitted_pats})
 
 # Get discharge confimation
 @app.get("/admission/discharge/confirm/{pat_id}")
 async def discharging_patient(request: _fastapi.Request, pat_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
-    pat_db = await _services.get_pat_by_id(pat_id, db)
-    room_db = await _services.get_ro_by_id(pat_db.admitted_to, db)
+    try:
+        pat_db = await _services.get_admitted_pat(pat_id, db)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('discharge_areyousure.html', context = {'request' : request, 'statusMessage' : e.detail})
+
+    room_db = pat_db.room
     statusMessage = "Are you sure you want to discharge " + pat_db.name + " from " + room_db.name + "?"
     return templates.TemplateResponse('discharge_areyousure.html', context = {'request' : request, 'pat_id' : pat_id, 'room_id': room_db.id, 'room_name' : room_db.name, 'pat_name' : pat_db.name, 'statusMessage' : statusMessage})
 
@@ -594,23 +685,73 @@ async def discharging_patient(request: _fastapi.Request, pat_id : int, db: _orm.
 @app.post("/admission/discharge/confirm/{pat_id}")
 async def discharged_patient(request: _fastapi.Request, pat_id : int, db: _orm.Session = _fastapi.Depends(_services.get_db)):
     
-    # Get pat and room
-    pat_db = await _services.get_pat_by_id(pat_id, db)
-    room_db = await _services.get_ro_by_id(pat_db.admitted_to, db)
-
     # Discharge both
-    pat_db.admitted_to = 0
-    room_db.occupied_by = 0
-    room_db.occupied = False
-
-
-    db.commit()
-    db.refresh(pat_db)
-    db.refresh(room_db)
+    try:
+        pat_db, room_db = await _services.discharge_pat(pat_id, db)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('discharge_areyousure.html', context = {'request' : request, 'statusMessage' : e.detail})
 
     statusMessage = "Successfully discharged " + pat_db.name + " from " + room_db.name + "!"
     return templates.TemplateResponse('discharge_areyousure.html', context = {'request' : request, 'statusMessage' : statusMessage})
 
+# Discharge the selected patients in one transaction
+@app.post("/admission/discharge/batch")
+async def discharged_patients(request: _fastapi.Request, pat_ids : List[int] = _fastapi.Form([]), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if not pat_ids:
+        return templates.TemplateResponse('discharge_areyousure.html', context = {'request' : request, 'statusMessage' : "No patients selected!"})
+
+    if len(pat_ids) > _services.BATCH_MAX:
+        statusMessage = "At most " + str(_services.BATCH_MAX) + " patients can be discharged at once!"
+        return templates.TemplateResponse('discharge_areyousure.html', context = {'request' : request, 'statusMessage' : statusMessage})
+
+    try:
+        results, applied = await _services.apply_admissions([], pat_ids, db)
+    except _fastapi.HTTPException as e:
+        return templates.TemplateResponse('discharge_areyousure.html', context = {'request' : request, 'statusMessage' : e.detail})
+
+    done = sum(item["status"] == 200 for item in results)
+    statusMessage = "Discharged " + str(done) + " of " + str(len(results)) + " patients!"
+    return templates.TemplateResponse('discharge_areyousure.html', context = {'request' : request, 'statusMessage' : statusMessage, 'results' : results})
+
+
+
+#*********************************************************
+
+# BULK IMPORT & EXPORT
+
+#*********************************************************
+
+# Stream CSV (with header row) or NDJSON rows into a table, reports per-row errors
+@app.post("/import/{table}")
+async def bulk_import(request: _fastapi.Request, table : str, format : str = "csv", db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if table not in _services.IMPORT_SCHEMAS:
+        raise _fastapi.HTTPException(status_code=404, detail = "Table " + table + " can not be imported!")
+
+    if format not in ("csv", "ndjson"):
+        raise _fastapi.HTTPException(status_code=400, detail = "Format must be csv or ndjson!")
+
+    return await _services.import_rows(table, format, request.stream(), db)
+
+
+# Stream a table as CSV or NDJSON, treatments filter by patient, doctor and cost range, patients by doctor
+@app.get("/export/{table}")
+async def bulk_export(table : str, format : str = "csv", patient : Union[int, None] = None, doctor : Union[int, None] = None,
+                      min_cost : Union[int, None] = None, max_cost : Union[int, None] = None, db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if table not in _services.EXPORT_COLUMNS:
+        raise _fastapi.HTTPException(status_code=404, detail = "Table " + table + " can not be exported!")
+
+    if format not in ("csv", "ndjson"):
+        raise _fastapi.HTTPException(status_code=400, detail = "Format must be csv or ndjson!")
+
+    filters = {key : value for key, value in (("patient", patient), ("doctor", doctor), ("min_cost", min_cost), ("max_cost", max_cost)) if value is not None}
+    for key in filters:
+        if key not in _services.EXPORT_FILTERS[table]:
+            raise _fastapi.HTTPException(status_code=400, detail = "Table " + table + " can not be filtered by " + key + "!")
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    headers = {"Content-Disposition" : "attachment; filename=" + table + "." + format}
+    return _responses.StreamingResponse(_services.iter_export(table, format, db, **filters), media_type = media_type, headers = headers)
+
 
 
 #*********************************************************
@@ -621,9 +762,7 @@ async def discharged_patient(request: _fastapi.Request, pat_id : int, db: _orm.S
 
 # Get main page
 @app.get("/messageboard")
-async def messageboard(request: _fastapi.Request, account_type: Union[str, None] = _fastapi.Cookie(default=None), guest_name: Union[str, None] = _fastapi.Cookie(default=None)):
-    global message_id
-
+async def messageboard(request: _fastapi.Request, before : int = 0, limit : int = _services.PAGE_SIZE, account_type: Union[str, None] = _fastapi.Cookie(default=None), guest_name: Union[str, None] = _fastapi.Cookie(default=None), db: _orm.Session = _fastapi.Depends(_services.get_db)):
     if not account_type == "Admin" and not guest_name:
         acc_type = "Guest"
         guest_nam = None
@@ -636,17 +775,17 @@ async def messageboard(request: _fastapi.Request, account_type: Union[str, None]
         guest_nam = guest_name
         
         
-        mess_list = [message_db[i] for i in range(1,message_id) if  message_db[i]['sender'] == guest_name or message_db[i]['receiver'] == guest_name]
+        mess_list, next_before = await _services.get_msgs_of(guest_name, db, before = before, limit = limit)
 
-        resp = templates.TemplateResponse('messageboard.html', context = {'request' : request, 'account_type' : acc_type, 'guest_name' : guest_nam, 'mess' : mess_list})
+        resp = templates.TemplateResponse('messageboard.html', context = {'request' : request, 'account_type' : acc_type, 'guest_name' : guest_nam, 'mess' : mess_list, 'before' : before, 'next_before' : next_before, 'limit' : limit})
 
     else:
         guest_nam = None 
         acc_type = "Admin"
 
-        mess_list = [message_db[i] for i in range(1,message_id) if message_db[i]['receiver'] == "Admin"]
+        mess_list, next_before = await _services.get_msgs_to("Admin", db, before = before, limit = limit)
 
-        resp = templates.TemplateResponse('messageboard.html', context = {'request' : request, 'account_type' : acc_type, 'guest_name' : guest_nam, 'mess' : mess_list})
+        resp = templates.TemplateResponse('messageboard.html', context = {'request' : request, 'account_type' : acc_type, 'guest_name' : guest_nam, 'mess' : mess_list, 'before' : before, 'next_before' : next_before, 'limit' : limit})
 
     return resp
 
@@ -679,7 +818,7 @@ async def on_exit(request: _fastapi.Request):
 
 # Admin auth
 @app.post("/messageboard/admin")
-async def messageboard_admin(request: _fastapi.Request, password : str = _fastapi.Form("admin123")):
+async def messageboard_admin(request: _fastapi.Request, password : str = _fastapi.Form("admin123"), db: _orm.Session = _fastapi.Depends(_services.get_db)):
     acc_type = "Guest"
     guest_nam = None
 
@@ -690,9 +829,9 @@ async def messageboard_admin(request: _fastapi.Request, password : str = _fastap
     
     else:
         acc_type = "Admin"
-        mess_list = [message_db[i] for i in range(1,message_id) if message_db[i]['receiver'] == "Admin"]
+        mess_list, next_before = await _services.get_msgs_to("Admin", db)
 
-        resp = templates.TemplateResponse('messageboard.html', context = {'request' : request, 'account_type' : acc_type, 'guest_name' : guest_nam, 'mess' : mess_list})
+        resp = templates.TemplateResponse('messageboard.html', context = {'request' : request, 'account_type' : acc_type, 'guest_name' : guest_nam, 'mess' : mess_list, 'next_before' : next_before, 'limit' : _services.PAGE_SIZE})
         resp.set_cookie(key='account_type', value='Admin')
         resp.set_cookie(key='token', value=str(_jwt.encode(_json.loads(_json.dumps({'name' : 'admin', 'password' : 'admin123'}, indent = 4, sort_keys=True, default=str)), JWT_SECRET_ADMIN)))    
         
@@ -700,23 +839,19 @@ async def messageboard_admin(request: _fastapi.Request, password : str = _fastap
 
 # Send message - Guest
 @app.get("/messageboard/post")
-async def messageboard_post_guest(request: _fastapi.Request, subject : str = "", messagecontent : str = "", guest_name: Union[str, None] = _fastapi.Cookie(default=None)):
-    global message_id
-
-    message = {
-        'id' : message_id, 
-        'sender' : guest_name,
-        'receiver' : "Admin",        
-        'content' :  messagecontent,
-        'subject' : subject,
-        'date' : _dt.datetime.utcnow().replace(tzinfo=from_zone).astimezone(to_zone)
-    }
-    
-    
-
-    message_db[message_id] = message
+async def messageboard_post_guest(request: _fastapi.Request, subject : str = "", messagecontent : str = "", reply_to : int = 0, guest_name: Union[str, None] = _fastapi.Cookie(default=None), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if not guest_name:
+        return _fastapi.responses.RedirectResponse("/messageboard")
+
+    message = _schemas._MessageCreate(
+        sender = guest_name,
+        receiver = "Admin",
+        content = messagecontent,
+        subject = subject,
+        parent_id = reply_to or None
+    )
 
-    message_id += 1
+    _push.hub.publish(await _services.create_msg(message, db))
 
     return _fastapi.responses.RedirectResponse("/messageboard")
 
@@ -727,20 +862,117 @@ async def messageboard_post_admin(request: _fastapi.Request, mes_id : int, guest
     return templates.TemplateResponse("message_response.html", context={'request' : request, 'mes_id' : mes_id, 'guest_name' : guest_name, 'subject' : subject})
 
 @app.post("/messageboard/admin/post/{mes_id}/{guest_name}/{subject}")
-async def messageboard_post_admin(request: _fastapi.Request, mes_id : int, guest_name : str, subject : str, messagecontent : str = _fastapi.Form()):
-    global message_id
+async def messageboard_post_admin(request: _fastapi.Request, mes_id : int, guest_name : str, subject : str, messagecontent : str = _fastapi.Form(), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    message = _schemas._MessageCreate(
+        sender = "Admin",
+        receiver = guest_name,
+        content = messagecontent,
+        subject = "Reply to " + subject,
+        parent_id = mes_id
+    )
 
-    message = {
-        'id' : message_id, 
-        'sender' : "Admin",
-        'receiver' : guest_name,        
-        'content' :  messagecontent,
-        'subject' : "Reply to " + subject,
-        'date' : _dt.datetime.utcnow().replace(tzinfo=from_zone).astimezone(to_zone)
-    }
+    _push.hub.publish(await _services.create_msg(message, db))
 
-    message_db[message_id] = message
+    return _fastapi.responses.RedirectResponse("/messageboard/admin")
 
-    message_id += 1
 
-    return _fastapi.responses.RedirectResponse("/messageboard/admin")
+# Ranked message search - Admin
+@app.get("/messageboard/search")
+async def messageboard_search(request: _fastapi.Request, q : str = "", limit : int = _services.PAGE_SIZE, account_type: Union[str, None] = _fastapi.Cookie(default=None), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if account_type != "Admin":
+        return _fastapi.responses.RedirectResponse("/messageboard")
+
+    mess = await _services.search_msgs(q, db, limit = limit)
+    return templates.TemplateResponse("message_search.html", context={'request' : request, 'query' : q, 'mess' : mess})
+
+# Conversations with the latest activity first - Admin
+@app.get("/messageboard/threads")
+async def messageboard_threads(request: _fastapi.Request, before : int = 0, limit : int = _services.PAGE_SIZE, account_type: Union[str, None] = _fastapi.Cookie(default=None), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    if account_type != "Admin":
+        return _fastapi.responses.RedirectResponse("/messageboard")
+
+    threads, next_before = await _services.get_threads(db, before = before, limit = limit)
+    return templates.TemplateResponse("message_threads.html", context={'request' : request, 'threads' : threads, 'before' : before, 'next_before' : next_before, 'limit' : limit})
+
+# One conversation oldest first - Admin or the guest in it
+@app.get("/messageboard/threads/{thread_id}")
+async def messageboard_thread(request: _fastapi.Request, thread_id : int, account_type: Union[str, None] = _fastapi.Cookie(default=None), guest_name: Union[str, None] = _fastapi.Cookie(default=None), db: _orm.Session = _fastapi.Depends(_services.get_db)):
+    user = _board_user(account_type, guest_name)
+    if user is None:
+        return _fastapi.responses.RedirectResponse("/messageboard")
+
+    found = await _services.get_thread(thread_id, db)
+    if found is None or (user != "Admin" and found[0].guest != user):
+        raise _fastapi.HTTPException(status_code=404, detail="Conversation does not exist!")
+
+    thread, mess = found
+    return templates.TemplateResponse("message_thread.html", context={'request' : request, 'account_type' : "Admin" if user == "Admin" else "Guest", 'thread' : thread, 'mess' : mess})
+
+
+# Live updates for the open inbox, as Server-Sent Events or over a WebSocket
+PUSH_PING = 15  # Seconds between keep-alive comments on idle event streams
+
+# Message board user of a request, "Admin", a guest name or None
+def _board_user(account_type : Union[str, None], guest_name : Union[str, None]):
+    return "Admin" if account_type == "Admin" else guest_name or None
+
+@app.get("/messageboard/events")
+async def messageboard_events(account_type: Union[str, None] = _fastapi.Cookie(default=None), guest_name: Union[str, None] = _fastapi.Cookie(default=None)):
+    name = _board_user(account_type, guest_name)
+    if name is None:
+        raise _fastapi.HTTPException(status_code=403, detail = "Set a guest name or log in as admin first!")
+
+    sub = _push.hub.subscribe(name)
+
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                mes = await sub.get(PUSH_PING)
+                if mes is None:
+                    yield ": ping\n\n"
+                elif mes is _push.CLOSED:
+                    # Fell too far behind, the page reloads the inbox
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+                else:
+                    yield "event: message\ndata: " + mes.json() + "\n\n"
+        finally:
+            _push.hub.unsubscribe(sub)
+
+    return _responses.StreamingResponse(events(), media_type = "text/event-stream", headers = {"Cache-Control" : "no-cache", "X-Accel-Buffering" : "no"})
+
+@app.websocket("/messageboard/ws")
+async def messageboard_ws(websocket : _fastapi.WebSocket):
+    name = _board_user(websocket.cookies.get("account_type"), websocket.cookies.get("guest_name"))
+    if name is None:
+        await websocket.close(code = 1008)
+        return
+
+    await websocket.accept()
+    sub = _push.hub.subscribe(name)
+
+    # Nothing is expected from the client, a receive only returns on disconnect
+    disconnected = _asyncio.ensure_future(websocket.receive())
+
+    try:
+        while True:
+            next_mes = _asyncio.ensure_future(sub.get())
+            done, _ = await _asyncio.wait({next_mes, disconnected}, return_when = _asyncio.FIRST_COMPLETED)
+
+            if disconnected in done:
+                next_mes.cancel()
+                if disconnected.result()["type"] == "websocket.disconnect":
+                    return
+                disconnected = _asyncio.ensure_future(websocket.receive())
+                if next_mes not in done:
+                    continue
+
+            mes = next_mes.result()
+            if mes is _push.CLOSED:
+                await websocket.close(code = 1013)
+                return
+            await websocket.send_text(mes.json())
+    finally:
+        disconnected.cancel()
+        _push.hub.unsubscribe(sub)
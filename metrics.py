@@ -0,0 +1,253 @@
+# Request, SQL and template metrics in the Prometheus text format, served on /metrics
+#
+# @zgr2788
+#
+# Settings come from the environment (or the .env file loaded by database.py):
+#   HADMDB_METRICS    "on" (default) or "off"
+#
+# Per route: request latency, SQL statements and SQL time per request, template render time.
+# Per statement kind: SQL latency. Per template: render time.
+#
+# Every request gets a small counter object in a context variable. The SQL hooks add to it from
+# whichever thread runs the query, since the db pool and starlette's thread pool both run jobs in
+# a copy of the request context. Counters are per process, each gunicorn worker reports its own.
+#
+# Streamed templates are rendered while the response is sent, so their render time includes
+# the rows fetched from the database in between.
+
+import bisect as _bisect
+import contextvars as _contextvars
+import os as _os
+import threading as _threading
+import time as _time
+import jinja2 as _jinja2
+
+METRICS_ENABLED = _os.environ.get("HADMDB_METRICS", "on") == "on"
+
+# Histogram bucket bounds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+_lock = _threading.Lock()
+
+
+class Histogram:
+
+    def __init__(self, name : str, help : str, labels : tuple, buckets : tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [count per bucket (last one is +Inf), sum]
+
+    def observe(self, values : tuple, amount : float):
+        with _lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][_bisect.bisect_left(self.buckets, amount)] += 1
+            series[1] += amount
+
+    def expose(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " histogram"]
+
+        with _lock:
+            series = [(values, list(counts), total) for values, (counts, total) in self._series.items()]
+
+        for values, counts, total in sorted(series):
+            labels = ",".join('%s="%s"' % (key, _escape(value)) for key, value in zip(self.labels, values))
+            prefix = labels + "," if labels else ""
+
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, prefix, bound, cumulative))
+            lines.append("%s_sum{%s} %s" % (self.name, labels, round(total, 6)))
+            lines.append("%s_count{%s} %d" % (self.name, labels, cumulative))
+
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name : str, help : str, labels : tuple):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = {}
+
+    def inc(self, values : tuple, amount : float = 1):
+        with _lock:
+            self._series[values] = self._series.get(values, 0) + amount
+
+    def expose(self):
+        lines = ["# HELP " + self.name + " " + self.help, "# TYPE " + self.name + " counter"]
+
+        with _lock:
+            series = sorted(self._series.items())
+
+        for values, total in series:
+            labels = ",".join('%s="%s"' % (key, _escape(value)) for key, value in zip(self.labels, values))
+            lines.append("%s{%s} %s" % (self.name, labels, total))
+
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+requests_total = Counter("hadmdb_http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+request_seconds = Histogram("hadmdb_http_request_duration_seconds", "HTTP request latency until the last body chunk is sent.", ("method", "route"))
+request_statements = Histogram("hadmdb_http_request_sql_statements", "SQL statements executed per request.", ("method", "route"), COUNT_BUCKETS)
+request_sql_seconds = Histogram("hadmdb_http_request_sql_seconds", "SQL time per request.", ("method", "route"))
+request_render_seconds = Histogram("hadmdb_http_request_render_seconds", "Template render time per request.", ("method", "route"))
+sql_seconds = Histogram("hadmdb_sql_statement_duration_seconds", "SQL statement latency by statement kind.", ("kind",))
+render_seconds = Histogram("hadmdb_template_render_seconds", "Template render time by template.", ("template",))
+
+REGISTRY = (requests_total, request_seconds, request_statements, request_sql_seconds, request_render_seconds, sql_seconds, render_seconds)
+
+
+# Counters of the request being served: [statements, sql seconds, render seconds, asgi scope]
+_current = _contextvars.ContextVar("hadmdb_metrics_request", default = None)
+
+def expose():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+#*********************************************************
+
+# SQL
+
+#*********************************************************
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("hadmdb_query_start", []).append(_time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = _time.perf_counter() - conn.info["hadmdb_query_start"].pop()
+    kind = statement.lstrip()[:6].upper()
+    sql_seconds.observe((kind if kind in ("SELECT", "INSERT", "UPDATE", "DELETE") else "OTHER",), elapsed)
+
+    counters = _current.get()
+    if counters is not None:
+        counters[0] += 1
+        counters[1] += elapsed
+
+# Time every statement run on the engine
+def instrument_engine(engine):
+    import sqlalchemy as _sql
+
+    _sql.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    _sql.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+#*********************************************************
+
+# TEMPLATES
+
+#*********************************************************
+
+def _observe_render(name : str, elapsed : float):
+    render_seconds.observe((name,), elapsed)
+
+    counters = _current.get()
+    if counters is not None:
+        counters[2] += elapsed
+
+class _TimedTemplate(_jinja2.Template):
+
+    def render(self, *args, **kwargs):
+        start = _time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            _observe_render(self.name, _time.perf_counter() - start)
+
+    # Streamed rendering, only the time spent producing chunks counts
+    def generate(self, *args, **kwargs):
+        chunks = super().generate(*args, **kwargs)
+        elapsed = 0.0
+
+        try:
+            while True:
+                start = _time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += _time.perf_counter() - start
+                yield chunk
+        finally:
+            _observe_render(self.name, elapsed)
+
+# Time every template loaded from the environment from now on
+def instrument_templates(env : _jinja2.Environment):
+    env.template_class = _TimedTemplate
+
+
+#*********************************************************
+
+# MIDDLEWARE
+
+#*********************************************************
+
+_routes = None  # endpoint -> route path, built on the first request
+
+# Path template of the route that served a request, e.g. /billcheck/{pat_id}
+def _route(scope):
+    global _routes
+    if _routes is None:
+        _routes = {getattr(route, "endpoint", None) or getattr(route, "app", None) : route.path for route in scope["app"].router.routes}
+    return _routes.get(scope.get("endpoint"), "unmatched")
+
+# Method, route and path of the request being served, None outside requests
+def current_request():
+    counters = _current.get()
+    if counters is None:
+        return None
+    scope = counters[3]
+    return scope["method"], _route(scope), scope["path"]
+
+# Pure ASGI middleware, so streamed bodies are timed until their last chunk is sent
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        counters = [0, 0.0, 0.0, scope]
+        token = _current.set(counters)
+        start = _time.perf_counter()
+        status = [500, False]  # Response status, recorded yet
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                status[1] = True
+                self._record(scope, status[0], counters, _time.perf_counter() - start)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Unhandled errors and dropped connections never send the last chunk
+            if not status[1]:
+                self._record(scope, 500 if status[0] < 400 else status[0], counters, _time.perf_counter() - start)
+            _current.reset(token)
+
+    def _record(self, scope, status : int, counters : list, elapsed : float):
+        labels = (scope["method"], _route(scope))
+        requests_total.inc(labels + (str(status),))
+        request_seconds.observe(labels, elapsed)
+        request_statements.observe(labels, counters[0])
+        request_sql_seconds.observe(labels, counters[1])
+        request_render_seconds.observe(labels, counters[2])
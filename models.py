@@ -31,6 +31,9 @@ class Doctor(_database.Base):
     spec = _sql.Column(_sql.String, index = True)      # Specialization
     name = _sql.Column(_sql.String, index = True)      # Name
 
+    #Relationships
+    patients = _orm.relationship("Patient", back_populates = "doctor", passive_deletes = True)  # Removed by the database cascade
+
 
 #*********************************************************
 
@@ -82,6 +85,14 @@ class Room(_database.Base):
     id = _sql.Column(_sql.Integer, primary_key = True, index = True)  # Unique rooms id - pkey
     size = _sql.Column(_sql.Integer, index = True)      # Room size
 
+    # Free room lookup by size
+    __table_args__ = (_sql.Index("ix_rooms_occupied_size", "occupied", "size"),)
+
+    #Relationships
+    # occupied_by uses 0 for "free" and can not be a foreign key, the link is read only
+    # Admission and discharge write it with compare-and-set updates in services.py
+    patient = _orm.relationship("Patient", primaryjoin = "foreign(Room.occupied_by) == Patient.id", viewonly = True, uselist = False)
+
 
 #*********************************************************
 
@@ -101,6 +112,11 @@ class Patient(_database.Base):
     history = _sql.Column(_sql.String, index = True)      # History
     name = _sql.Column(_sql.String, index = True)      # Name
 
+    #Relationships
+    doctor = _orm.relationship("Doctor", back_populates = "patients")
+    treatments = _orm.relationship("Treatment", back_populates = "patient", passive_deletes = True, order_by = "Treatment.id")
+    room = _orm.relationship("Room", primaryjoin = "foreign(Patient.admitted_to) == Room.id", viewonly = True, uselist = False)  # Read only, like Room.patient
+
 #*********************************************************
 
 # TREATMENTS 
@@ -118,4 +134,63 @@ class Treatment(_database.Base):
     cost = _sql.Column(_sql.Integer, index = True)      # Cost
     name = _sql.Column(_sql.String, index = True)      # Name
 
-#*********************************************************
\ No newline at end of file
+    #Relationships
+    patient = _orm.relationship("Patient", back_populates = "treatments")
+
+#*********************************************************
+
+# MESSAGES 
+
+#*********************************************************
+
+class Message(_database.Base):
+
+    # Name
+    __tablename__ = "messages"
+
+    #Columns
+    id = _sql.Column(_sql.Integer, primary_key = True, index = True)  # Unique message id - pkey
+    sender = _sql.Column(_sql.String, index = True)      # Guest name or "Admin"
+    receiver = _sql.Column(_sql.String, index = True)    # Guest name or "Admin"
+    subject = _sql.Column(_sql.String)      # Subject
+    content = _sql.Column(_sql.String)      # Content
+    date = _sql.Column(_sql.DateTime, default = _dt.datetime.utcnow, index = True)  # Sent at, UTC - retention by age
+    parent_id = _sql.Column(_sql.Integer, nullable = True)       # Message replied to, None for a new conversation
+    thread_id = _sql.Column(_sql.Integer, index = True)          # Id of the first message of the conversation
+
+#*********************************************************
+
+# THREADS 
+
+#*********************************************************
+
+# One row per conversation, kept up to date with every message of it
+class Thread(_database.Base):
+
+    # Name
+    __tablename__ = "threads"
+
+    #Columns
+    id = _sql.Column(_sql.Integer, primary_key = True)  # Id of the first message - pkey
+    guest = _sql.Column(_sql.String, index = True)      # Guest talking to Admin
+    subject = _sql.Column(_sql.String)                  # Subject of the first message
+    last_message_id = _sql.Column(_sql.Integer, index = True)  # Newest message, orders threads by latest activity
+    last_date = _sql.Column(_sql.DateTime)              # Sent at of the newest message, UTC
+    messages = _sql.Column(_sql.Integer, default = 1)   # Messages in the thread
+
+#*********************************************************
+
+# META 
+
+#*********************************************************
+
+class Meta(_database.Base):
+
+    # Name
+    __tablename__ = "meta"
+
+    #Columns
+    key = _sql.Column(_sql.String, primary_key = True)  # Setting name, e.g. schema_version - pkey
+    value = _sql.Column(_sql.String)                    # Setting value
+
+#*********************************************************
@@ -0,0 +1,113 @@
+# Live message board push, fans new messages out to connected recipients
+#
+# @zgr2788
+#
+# Settings come from the environment (or the .env file loaded by database.py):
+#   HADMDB_PUSH_QUEUE    messages buffered per connection (default 64)
+#   HADMDB_PUSH_POLL     seconds between checks for messages stored by other workers, 0 turns it off (default 1)
+#
+# Every connection (SSE or WebSocket) subscribes with its user name, a guest name or "Admin",
+# and gets a bounded queue. Messages stored by this worker are published right away. Under
+# gunicorn a poller also picks up messages stored by the other workers, one indexed query per
+# interval and worker however many clients are connected.
+#
+# A connection whose queue is full is closed instead of buffering without bound. The browser
+# reconnects and reloads the inbox from the database.
+
+import asyncio as _asyncio
+import collections as _collections
+import os as _os
+
+PUSH_QUEUE = int(_os.environ.get("HADMDB_PUSH_QUEUE", 64))
+PUSH_POLL = float(_os.environ.get("HADMDB_PUSH_POLL", 1))
+RECENT_IDS = 4096  # Published message ids remembered, so the poller skips them
+
+CLOSED = object()  # Queued when a subscription is dropped
+
+
+class Subscription:
+
+    def __init__(self, name : str):
+        self.name = name
+        self.queue = _asyncio.Queue(maxsize = PUSH_QUEUE)
+        self.closed = False
+
+    # Next message, None after timeout seconds, CLOSED once the subscription was dropped
+    async def get(self, timeout : float = None):
+        try:
+            return await _asyncio.wait_for(self.queue.get(), timeout)
+        except _asyncio.TimeoutError:
+            return None
+
+
+class Hub:
+
+    def __init__(self):
+        self._subs = {}  # name -> set of subscriptions
+        self._recent = _collections.deque(maxlen = RECENT_IDS)
+        self._recent_set = set()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, name : str):
+        sub = Subscription(name)
+        self._subs.setdefault(name, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub : Subscription):
+        subs = self._subs.get(sub.name)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self._subs[sub.name]
+
+    def connections(self):
+        return sum(len(subs) for subs in self._subs.values())
+
+    def _remember(self, mes_id : int):
+        if len(self._recent) == RECENT_IDS:
+            self._recent_set.discard(self._recent[0])
+        self._recent.append(mes_id)
+        self._recent_set.add(mes_id)
+
+    # Deliver a message to its receiver, and to a guest sender for their sent list
+    # Runs on the event loop, never blocks, slow connections are dropped
+    def publish(self, mes):
+        if mes.id in self._recent_set:
+            return
+        self._remember(mes.id)
+        self.published += 1
+
+        names = {mes.receiver} if mes.sender == "Admin" else {mes.receiver, mes.sender}
+        for name in names:
+            for sub in list(self._subs.get(name, ())):
+                try:
+                    sub.queue.put_nowait(mes)
+                except _asyncio.QueueFull:
+                    self._drop(sub)
+
+    def _drop(self, sub : Subscription):
+        self.dropped += 1
+        sub.closed = True
+        self.unsubscribe(sub)
+
+        # Make room for the close marker, the client reloads everything anyway
+        while not sub.queue.empty():
+            sub.queue.get_nowait()
+        sub.queue.put_nowait(CLOSED)
+
+    # Publish messages stored by other workers, fetch(after_id) returns the newer ones in id order
+    async def poll(self, fetch, after_id : int, interval : float = PUSH_POLL):
+        while True:
+            await _asyncio.sleep(interval)
+
+            try:
+                for mes in await fetch(after_id):
+                    after_id = max(after_id, mes.id)
+                    self.publish(mes)
+            except Exception:
+                # Keep polling through a locked or briefly unavailable database
+                continue
+
+
+hub = Hub()
@@ -118,4 +118,89 @@ class Patient(_PatientCreate):
 
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+# Admitted patient with its room, read through Patient.room
+class AdmittedPatient(Patient):
+    room : Room
+
+    class Config:
+        orm_mode = True
+
+#*********************************************************
+
+# TREATMENT
+
+#*********************************************************
+
+class _TreatmentCreate(_pydantic.BaseModel):
+    name : str
+    cost : int
+    billed_to : int
+
+    class Config:
+        orm_mode = True 
+
+
+class Treatment(_TreatmentCreate):
+    id : int
+
+
+    class Config:
+        orm_mode = True
+
+
+#*********************************************************
+
+# BILLING
+
+#*********************************************************
+
+class BillTotal(_pydantic.BaseModel):
+    patient_id : int
+    patient_name : str
+    count : int
+    total : int
+
+    class Config:
+        orm_mode = True
+
+
+#*********************************************************
+
+# MESSAGE
+
+#*********************************************************
+
+class _MessageCreate(_pydantic.BaseModel):
+    sender : str
+    receiver : str
+    subject : str
+    content : str
+    parent_id : int = None
+
+    class Config:
+        orm_mode = True 
+
+
+class Message(_MessageCreate):
+    id : int
+    date : _dt.datetime
+    thread_id : int = None
+
+
+    class Config:
+        orm_mode = True
+
+
+class Thread(_pydantic.BaseModel):
+    id : int
+    guest : str
+    subject : str
+    last_message_id : int
+    last_date : _dt.datetime
+    messages : int
+
+    class Config:
+        orm_mode = True
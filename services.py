@@ -5,13 +5,26 @@
 import database as _database
 import models as _models
 import schemas as _schemas
+import cache as _cache
+import generator as _generator
 import sqlalchemy.orm as _orm
 import sqlalchemy as _sql
 import fastapi as _fastapi
 import fastapi.security as _security
 import jwt as _jwt
 import json as _json
+import re as _re
 import datetime as _dt
+import asyncio as _asyncio
+import functools as _functools
+import concurrent.futures as _futures
+import contextlib as _contextlib
+import contextvars as _contextvars
+import os as _os
+import csv as _csv
+import io as _io
+import orjson as _orjson
+import pydantic as _pydantic
 from dateutil import tz as _tz
 
 JWT_SECRET_ADMIN = 'ADMINSECRETHADMDB'
@@ -21,9 +34,199 @@ adminJWT = {'name' : 'admin', 'password' : 'admin123'} # standard admin password
 from_zone = _tz.gettz('UTC')
 to_zone = _tz.gettz('Turkey')
 
+# Listing page sizes, requested limits are capped at MAX_PAGE_SIZE
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+STREAM_BATCH = 500  # Rows fetched per round trip by the streaming iterators
+SEED_PATIENTS = int(_os.environ.get("HADMDB_SEED_PATIENTS", _generator.SCALES["demo"]))  # Patients generated into an empty database
+
+# FTS5 shadow indexes over the searchable text columns
+# Trigram tokenizer keeps the substring semantics of the old LIKE '%term%' search
+FTS_COLUMNS = {
+    "doctors" : ["name", "spec"],
+    "nurses" : ["name"],
+    "services" : ["name"],
+    "rooms" : ["name"],
+    "patients" : ["name"],
+    "messages" : ["subject", "content"],
+}
+FTS_MIN_TERM = 3  # Trigram index can not match shorter terms
+
+# Message search is ranked and matches whole words, stemmed, so messages get a word index
+FTS_TOKENIZERS = {
+    "messages" : "porter unicode61",
+}
+MESSAGE_SEARCH_WEIGHTS = (4.0, 1.0)  # bm25 weight of a match in the subject and in the content
+
+# Bounded thread pool for the blocking database work, keeps the event loop free
+DB_WORKERS = int(_os.environ.get("HADMDB_DB_WORKERS", 8))
+_db_executor = _futures.ThreadPoolExecutor(max_workers = DB_WORKERS, thread_name_prefix = "hadmdb-db")
+
+# Turn a blocking service function into a coroutine run on the db pool
+# The blocking version stays reachable as func.sync for calls from other pool jobs
+# Jobs run in a copy of the caller's context, so request metrics follow the queries into the pool
+def _run_in_pool(func):
+    @_functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = _asyncio.get_running_loop()
+        context = _contextvars.copy_context()
+        return await loop.run_in_executor(_db_executor, context.run, _functools.partial(func, *args, **kwargs))
+
+    wrapper.sync = func
+    return wrapper
+
+# Bump when the models change, create_database then brings older databases up to date
+# Every version after the first lists the statements migrating the previous one in MIGRATIONS, by the
+# table they migrate. Tables missing from the old database are created current and skip their statements.
+SCHEMA_VERSION = 4
+MIGRATIONS = {
+    2 : {},  # Message date index for the retention, created by create_database
+
+    # Message threads, old messages start a thread each and admin replies join the newest
+    # message of their guest with the replied subject, the only link the old replies kept
+    3 : {"messages" : [
+        "ALTER TABLE messages ADD COLUMN parent_id INTEGER",
+        "ALTER TABLE messages ADD COLUMN thread_id INTEGER",
+        "UPDATE messages SET parent_id = (SELECT m.id FROM messages m WHERE m.sender = messages.receiver AND m.receiver = 'Admin' AND 'Reply to ' || m.subject = messages.subject AND m.id < messages.id ORDER BY m.id DESC LIMIT 1) WHERE sender = 'Admin' AND subject LIKE 'Reply to %'",
+        "UPDATE messages SET thread_id = COALESCE(parent_id, id)",
+        "INSERT INTO threads (id, guest, subject, last_message_id, last_date, messages) SELECT r.id, CASE WHEN r.sender = 'Admin' THEN r.receiver ELSE r.sender END, r.subject, MAX(m.id), MAX(m.date), COUNT(*) FROM messages r JOIN messages m ON m.thread_id = r.id WHERE r.parent_id IS NULL GROUP BY r.id",
+    ]},
+    4 : {},  # Message search index, created and filled by create_fts_indexes
+}
+
+# Serializes initialization between the workers of one host
+INIT_LOCK = _os.environ.get("HADMDB_INIT_LOCK", (_database.engine.url.database or "hadmdb") + ".init.lock"
+                            if _database.engine.dialect.name == "sqlite" and _database.engine.url.database not in (None, "", ":memory:") else "./hadmdb.init.lock")
+
+# Value of a meta key, None when unset or before the meta table exists
+def _get_meta(conn, key : str):
+    try:
+        return conn.execute(_sql.select(_models.Meta.value).where(_models.Meta.key == key)).scalar()
+    except _sql.exc.OperationalError:
+        return None
+
+def _set_meta(conn, key : str, value):
+    conn.execute(_sql.delete(_models.Meta).where(_models.Meta.key == key))
+    conn.execute(_sql.insert(_models.Meta).values(key = key, value = str(value)))
+
 # Create
+# A current database costs one primary key lookup, older ones get tables, indexes and migrations
 def create_database():
-    return _database.Base.metadata.create_all(bind = _database.engine)
+    with _database.engine.connect() as conn:
+        version = int(_get_meta(conn, "schema_version") or 0)
+
+    if version >= SCHEMA_VERSION:
+        return
+
+    # Unversioned old databases have version 1, tables created here already have the current schema
+    existing = set(_sql.inspect(_database.engine).get_table_names())
+    _database.Base.metadata.create_all(bind = _database.engine)
+
+    with _database.engine.begin() as conn:
+        for step in range(max(version, 1) + 1, SCHEMA_VERSION + 1):
+            for table, statements in MIGRATIONS[step].items():
+                if table in existing:
+                    for statement in statements:
+                        conn.execute(_sql.text(statement))
+
+    # create_all skips existing tables, add indexes introduced since the database was created
+    for table in _database.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind = _database.engine, checkfirst = True)
+
+    create_fts_indexes()
+
+    with _database.engine.begin() as conn:
+        _set_meta(conn, "schema_version", SCHEMA_VERSION)
+
+# Exclusive file lock for the initialization, a no-op where flock is missing
+@_contextlib.contextmanager
+def _init_lock():
+    try:
+        import fcntl as _fcntl
+    except ImportError:
+        yield
+        return
+
+    with open(INIT_LOCK, "a") as f:
+        _fcntl.flock(f, _fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            _fcntl.flock(f, _fcntl.LOCK_UN)
+
+# Startup: create or migrate the schema and seed an empty database, at most once across workers
+# Workers finding a current, seeded database skip the lock, two primary key lookups in all
+@_run_in_pool
+def init_database():
+    with _database.engine.connect() as conn:
+        ready = int(_get_meta(conn, "schema_version") or 0) >= SCHEMA_VERSION and _get_meta(conn, "seeded") is not None
+
+    if ready:
+        return
+
+    with _init_lock():
+        create_database()
+
+        with _database.engine.connect() as conn:
+            if _get_meta(conn, "seeded") is not None:
+                return
+
+            # Databases with data from before the seeded flag are not seeded again
+            empty = conn.execute(_sql.select(_models.Doctor.id).limit(1)).first() is None
+
+        if empty:
+            with _database.SessionLocal() as db:
+                insert_dummy_data.sync(db)
+
+        with _database.engine.begin() as conn:
+            _set_meta(conn, "seeded", SEED_PATIENTS if empty else 0)
+
+# Create the FTS5 tables and the triggers keeping them in sync with their base tables
+def create_fts_indexes():
+    if _database.engine.dialect.name != "sqlite":
+        return
+
+    with _database.engine.begin() as conn:
+        for table, columns in FTS_COLUMNS.items():
+            fts = table + "_fts"
+            cols = ", ".join(columns)
+            new_cols = ", ".join("new." + col for col in columns)
+            old_cols = ", ".join("old." + col for col in columns)
+            tokenize = FTS_TOKENIZERS.get(table, "trigram")
+
+            exists = conn.execute(_sql.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name" : fts}).first()
+
+            conn.execute(_sql.text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({cols}, content = '{table}', content_rowid = 'id', tokenize = '{tokenize}')"))
+            conn.execute(_sql.text(f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols}); END"))
+            conn.execute(_sql.text(f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); END"))
+            conn.execute(_sql.text(f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {cols} ON {table} BEGIN INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols}); INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_cols}); END"))
+
+            # Index rows written before the FTS table existed
+            if not exists:
+                conn.execute(_sql.text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+# Search a text column through its FTS index, keyset paged like _get_page
+def _search(model, schema, column : str, term : str, db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    table = model.__tablename__
+    term = term.strip()
+
+    # Shorter terms would need a full table scan, the trigram index can not serve them
+    if len(term) < FTS_MIN_TERM:
+        raise _fastapi.HTTPException(status_code = 400, detail = f"Search terms need at least {FTS_MIN_TERM} characters!")
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    items = db.query(model).filter(model.id > after_id)
+
+    if _database.engine.dialect.name != "sqlite":
+        items = items.filter(getattr(model, column).contains(term))
+    else:
+        match = '"' + term.replace('"', '""') + '"'
+        items = items.filter(_sql.text(f"{table}.id IN (SELECT rowid FROM {table}_fts WHERE {column} MATCH :match)")).params(match = match)
+
+    items = items.order_by(model.id).limit(limit + 1).all()
+    next_id = items[limit - 1].id if len(items) > limit else None
+    return list(map(schema.from_orm, items[:limit])), next_id
 
 # Get db
 def get_db():
@@ -34,6 +237,17 @@ def get_db():
     finally:
         db.close()
 
+# Schema of a row, None if missing
+def _from_orm(schema, obj):
+    return None if obj is None else schema.from_orm(obj)
+
+# Keyset page over a table ordered by id, returns (items, next cursor or None)
+def _get_page(model, schema, db : _orm.Session, after_id : int, limit : int):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    items = db.query(model).filter(model.id > after_id).order_by(model.id).limit(limit + 1).all()
+    next_id = items[limit - 1].id if len(items) > limit else None
+    return list(map(schema.from_orm, items[:limit])), next_id
+
 # Auth for admin
 async def auth_admin(password : str):
     token = None
@@ -43,78 +257,11 @@ async def auth_admin(password : str):
 
     return token, False 
 
-# Insert some doctors, nurses, rooms, personnel and patients
-async def insert_dummy_data(db : _orm.Session):
-    
-    # Doctors
-    docNames = ["Gus Fring", "Michael Scott", "Yamac Kocovali", "Ramiz Karaeski", "Ezel Bayraktar", "Mahmut Orhan", "Ismet Inonu"]
-    docSpecs = ["Heart Surgeon", "ENT Specialist", "Ophthalmologist", "Dermatologist", "Urologist", "ENT Specialist", "Dermatologist"]
-
-    for i in range(len(docNames)):
-        docObj = _models.Doctor(
-        name = docNames[i],
-        spec = docSpecs[i]  
-        )
-        db.add(docObj)
-        db.commit()
-        db.refresh(docObj)
-    
-    # Nurses
-    nurseNames = ["Florence Nightingale", "Dorothea Dix", "Margaret Sanger", "Virginia Henderson", "Clara Barton", "Mary Eliza Mahoney", "Mary Breckinridge"]
-    
-    for i in range(len(nurseNames)):
-        nurObj = _models.Nurse(
-        name = nurseNames[i]  
-        )
-        db.add(nurObj)
-        db.commit()
-        db.refresh(nurObj)
-    
-    # Personnel
-    perNames = ["Walter White", "Jesse Pinkman", "Mike Ehrmantraut", "Jimmy McGill", "Patrick Bateman", "Jack Napier", "Antonio Montana"]
-    perSpecs = ["Cook", "Cook", "Security Specialist", "Legal Advisor", "Financial Advisor", "Workspace Ethics Advisor", "Security Specialist"]
-
-    for i in range(len(perNames)):
-        
-        perObj = _models.Service(
-        name = perNames[i],
-        type = perSpecs[i]  
-        )
-
-        db.add(perObj)
-        db.commit()
-        db.refresh(perObj)
-
-    # Rooms
-    roNames = ["White Room", "Blue Room", "Red Room", "Pink Room", "Purple Room", "Orange Room", "Black Room"]
-    roSizes = [250, 350, 270, 450, 160, 580, 330]
-
-    for i in range(len(roNames)):
-      
-      roObj = _models.Room(
-      name = roNames[i],
-      size = roSizes[i]  
-      )
-      db.add(roObj)
-      db.commit()
-      db.refresh(roObj)
-
-    # Patients
-    patNames = ["Thomas Shelby", "Arthur Shelby", "John Shelby", "Ragnar Lothbrok", "Bjorn Lothbrok", "Miles Morales", "Michelle Obama"]
-    patHist = ["Heart Attack", "Nosebleed", "Astigmatism + Myopia", "Vitiligo", "Syphilis", "Runny Nose", "Eczema"]
-    patTreatBy = [1, 2, 3, 4, 5, 6, 7]
-
-    for i in range(len(patNames)):
-      
-      patObj = _models.Patient(
-      name = patNames[i],
-      history = patHist[i],
-      treated_by = patTreatBy[i]  
-      )
-
-      db.add(patObj)
-      db.commit()
-      db.refresh(patObj) 
+# Seed the database with a small generated hospital
+@_run_in_pool
+def insert_dummy_data(db : _orm.Session):
+    _generator.generate(SEED_PATIENTS, seed = 0, engine = db.get_bind())
+    _cache.entities.clear()
 
 #*********************************************************
 
@@ -123,11 +270,13 @@ async def insert_dummy_data(db : _orm.Session):
 #*********************************************************
 
 # Doctor query by id
-async def get_doc_by_id(id : int, db : _orm.Session):
-    return db.query(_models.Doctor).filter(_models.Doctor.id == id).first()
+@_run_in_pool
+def get_doc_by_id(id : int, db : _orm.Session):
+    return _cache.entities.read_through("doctors", id, lambda: _from_orm(_schemas.Doctor, db.query(_models.Doctor).filter(_models.Doctor.id == id).first()))
 
 # Create new doctor
-async def create_doc(doc : _schemas._DoctorCreate, db : _orm.Session):
+@_run_in_pool
+def create_doc(doc : _schemas._DoctorCreate, db : _orm.Session):
         
     # New doctor object
     docObj = _models.Doctor(
@@ -142,35 +291,38 @@ async def create_doc(doc : _schemas._DoctorCreate, db : _orm.Session):
     return docObj
 
 # Delete doctor
-async def delete_doc(doc_id : int , db : _orm.Session):
-    doc_db =  await get_doc_by_id(doc_id, db)
+@_run_in_pool
+def delete_doc(doc_id : int , db : _orm.Session):
+    doc_db = db.query(_models.Doctor).filter(_models.Doctor.id == doc_id).first()
 
     if doc_db is None:
         raise _fastapi.HTTPException(status_code=404, detail = "Doctor ID not found in database!")
     
-    # Delete all patients of a doctor for cascade
-    pats = db.query(_models.Patient).filter(_models.Patient.treated_by == doc_db.id).all()
-
-    for pat in pats:
-        await delete_pat(pat.id, db)
+    # Delete all patients of a doctor for cascade, in the same transaction
+    _delete_pats(_models.Patient.treated_by == doc_db.id, db)
 
     db.delete(doc_db)
     db.commit()
 
+    # Set-based cascade, patient ids are not known here
+    _cache.entities.invalidate("doctors", doc_id)
+    for table in ("patients", "rooms"):
+        _cache.entities.invalidate(table)
+
 # Get doctors by name
-async def get_docs_by_name(doc_name : str, db : _orm.Session):
-    items = db.query(_models.Doctor).filter(_models.Doctor.name.contains(doc_name))
-    return list(map(_schemas.Doctor.from_orm, items))
+@_run_in_pool
+def get_docs_by_name(doc_name : str, db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _search(_models.Doctor, _schemas.Doctor, "name", doc_name, db, after_id, limit)
 
 # Get doctors by spec
-async def get_docs_by_spec(spec_name : str, db : _orm.Session):
-    items = db.query(_models.Doctor).filter(_models.Doctor.spec.contains(spec_name))
-    return list(map(_schemas.Doctor.from_orm, items))
+@_run_in_pool
+def get_docs_by_spec(spec_name : str, db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _search(_models.Doctor, _schemas.Doctor, "spec", spec_name, db, after_id, limit)
 
-# Get all docs
-async def get_docs(db : _orm.Session):
-    items = db.query(_models.Doctor).filter(_models.Doctor.spec.contains(''))
-    return list(map(_schemas.Doctor.from_orm, items))
+# Get one page of docs
+@_run_in_pool
+def get_docs_page(db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _get_page(_models.Doctor, _schemas.Doctor, db, after_id, limit)
 
 
 #*********************************************************
@@ -180,11 +332,13 @@ async def get_docs(db : _orm.Session):
 #*********************************************************
 
 # Nurse query by id
-async def get_nur_by_id(id : int, db : _orm.Session):
-    return db.query(_models.Nurse).filter(_models.Nurse.id == id).first()
+@_run_in_pool
+def get_nur_by_id(id : int, db : _orm.Session):
+    return _cache.entities.read_through("nurses", id, lambda: _from_orm(_schemas.Nurse, db.query(_models.Nurse).filter(_models.Nurse.id == id).first()))
 
 # Create new nurse
-async def create_nur(nur : _schemas._NurseCreate, db : _orm.Session):
+@_run_in_pool
+def create_nur(nur : _schemas._NurseCreate, db : _orm.Session):
         
     # New nurse object
     nurObj = _models.Nurse(
@@ -198,24 +352,26 @@ async def create_nur(nur : _schemas._NurseCreate, db : _orm.Session):
     return nurObj
 
 # Delete nurse
-async def delete_nur(nur_id : int , db : _orm.Session):
-    nur_db =  await get_nur_by_id(nur_id, db)
+@_run_in_pool
+def delete_nur(nur_id : int , db : _orm.Session):
+    nur_db = db.query(_models.Nurse).filter(_models.Nurse.id == nur_id).first()
 
     if nur_db is None:
         raise _fastapi.HTTPException(status_code=404, detail = "Nurse ID not found in database!")
 
     db.delete(nur_db)
     db.commit()
+    _cache.entities.invalidate("nurses", nur_id)
 
 # Get nurses by name
-async def get_nurs_by_name(nur_name : str, db : _orm.Session):
-    items = db.query(_models.Nurse).filter(_models.Nurse.name.contains(nur_name))
-    return list(map(_schemas.Nurse.from_orm, items))
+@_run_in_pool
+def get_nurs_by_name(nur_name : str, db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _search(_models.Nurse, _schemas.Nurse, "name", nur_name, db, after_id, limit)
 
-# Get all nurses
-async def get_nurses(db : _orm.Session):
-    items = db.query(_models.Nurse).filter(_models.Nurse.name.contains(''))
-    return list(map(_schemas.Nurse.from_orm, items))
+# Get one page of nurses
+@_run_in_pool
+def get_nurses_page(db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _get_page(_models.Nurse, _schemas.Nurse, db, after_id, limit)
 
 
 #*********************************************************
@@ -225,11 +381,13 @@ async def get_nurses(db : _orm.Session):
 #*********************************************************
 
 # Service query by id
-async def get_ser_by_id(id : int, db : _orm.Session):
-    return db.query(_models.Service).filter(_models.Service.id == id).first()
+@_run_in_pool
+def get_ser_by_id(id : int, db : _orm.Session):
+    return _cache.entities.read_through("services", id, lambda: _from_orm(_schemas.Service, db.query(_models.Service).filter(_models.Service.id == id).first()))
 
 # Create new ser
-async def create_ser(ser : _schemas._ServiceCreate, db : _orm.Session):
+@_run_in_pool
+def create_ser(ser : _schemas._ServiceCreate, db : _orm.Session):
         
     # New doctor object
     serObj = _models.Service(
@@ -244,24 +402,26 @@ async def create_ser(ser : _schemas._ServiceCreate, db : _orm.Session):
     return serObj
 
 # Delete ser
-async def delete_ser(ser_id : int , db : _orm.Session):
-    ser_db =  await get_ser_by_id(ser_id, db)
+@_run_in_pool
+def delete_ser(ser_id : int , db : _orm.Session):
+    ser_db = db.query(_models.Service).filter(_models.Service.id == ser_id).first()
 
     if ser_db is None:
         raise _fastapi.HTTPException(status_code=404, detail = "Personnel ID not found in database!")
 
     db.delete(ser_db)
     db.commit()
+    _cache.entities.invalidate("services", ser_id)
 
 # Get sers by name
-async def get_sers_by_name(ser_name : str, db : _orm.Session):
-    items = db.query(_models.Service).filter(_models.Service.name.contains(ser_name))
-    return list(map(_schemas.Service.from_orm, items))
+@_run_in_pool
+def get_sers_by_name(ser_name : str, db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _search(_models.Service, _schemas.Service, "name", ser_name, db, after_id, limit)
 
-# Get all sers
-async def get_sers(db : _orm.Session):
-    items = db.query(_models.Service).filter(_models.Service.type.contains(''))
-    return list(map(_schemas.Service.from_orm, items))
+# Get one page of sers
+@_run_in_pool
+def get_sers_page(db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _get_page(_models.Service, _schemas.Service, db, after_id, limit)
 
 
 #*********************************************************
@@ -271,11 +431,13 @@ async def get_sers(db : _orm.Session):
 #*********************************************************
 
 # ro query by id
-async def get_ro_by_id(id : int, db : _orm.Session):
-    return db.query(_models.Room).filter(_models.Room.id == id).first()
+@_run_in_pool
+def get_ro_by_id(id : int, db : _orm.Session):
+    return _cache.entities.read_through("rooms", id, lambda: _from_orm(_schemas.Room, db.query(_models.Room).filter(_models.Room.id == id).first()))
 
 # Create new ro
-async def create_ro(ro : _schemas._RoomCreate, db : _orm.Session):
+@_run_in_pool
+def create_ro(ro : _schemas._RoomCreate, db : _orm.Session):
         
     # New doctor object
     roObj = _models.Room(
@@ -290,34 +452,39 @@ async def create_ro(ro : _schemas._RoomCreate, db : _orm.Session):
     return roObj
 
 # Delete ro
-async def delete_ro(ro_id : int , db : _orm.Session):
-    ro_db =  await get_ro_by_id(ro_id, db)
+@_run_in_pool
+def delete_ro(ro_id : int , db : _orm.Session):
+    ro_db = db.query(_models.Room).filter(_models.Room.id == ro_id).first()
 
     if ro_db is None:
         raise _fastapi.HTTPException(status_code=404, detail = "Room ID not found in database!")
     
-    if ro_db.occupied:
-        pat_id = ro_db.occupied_by
-        pat_db = await get_pat_by_id(pat_id,db)
-        pat_db.admitted_to = 0
-        
-        db.commit()
-        db.refresh(pat_db)
-
-
+    # Release the patient in the same transaction
+    pat_id = ro_db.occupied_by if ro_db.occupied else 0
+    if pat_id:
+        db.query(_models.Patient).filter(_models.Patient.id == pat_id, _models.Patient.admitted_to == ro_id).update({_models.Patient.admitted_to : 0}, synchronize_session = False)
 
     db.delete(ro_db)
     db.commit()
 
+    _cache.entities.invalidate("rooms", ro_id)
+    if pat_id:
+        _cache.entities.invalidate("patients", pat_id)
+
 # Get ros by name
-async def get_ros_by_name(ro_name : str, db : _orm.Session):
-    items = db.query(_models.Room).filter(_models.Room.name.contains(ro_name))
-    return list(map(_schemas.Room.from_orm, items))
+@_run_in_pool
+def get_ros_by_name(ro_name : str, db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _search(_models.Room, _schemas.Room, "name", ro_name, db, after_id, limit)
 
-# Get all ros
-async def get_ros(db : _orm.Session):
-    items = db.query(_models.Room).filter(_models.Room.name.contains(''))
-    return list(map(_schemas.Room.from_orm, items))
+# Stream all ros through a server-side cursor, consumed lazily by the template
+def iter_ros(db : _orm.Session):
+    items = db.query(_models.Room).order_by(_models.Room.id).yield_per(STREAM_BATCH)
+    return map(_schemas.Room.from_orm, items)
+
+# Get one page of ros
+@_run_in_pool
+def get_ros_page(db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _get_page(_models.Room, _schemas.Room, db, after_id, limit)
 
 
 
@@ -329,11 +496,13 @@ async def get_ros(db : _orm.Session):
 #*********************************************************
 
 # pat query by id
-async def get_pat_by_id(id : int, db : _orm.Session):
-    return db.query(_models.Patient).filter(_models.Patient.id == id).first()
+@_run_in_pool
+def get_pat_by_id(id : int, db : _orm.Session):
+    return _cache.entities.read_through("patients", id, lambda: _from_orm(_schemas.Patient, db.query(_models.Patient).filter(_models.Patient.id == id).first()))
 
 # Create new pat
-async def create_pat(pat : _schemas._RoomCreate, db : _orm.Session):
+@_run_in_pool
+def create_pat(pat : _schemas._RoomCreate, db : _orm.Session):
         
     # New doctor object
     patObj = _models.Patient(
@@ -348,33 +517,759 @@ async def create_pat(pat : _schemas._RoomCreate, db : _orm.Session):
     db.refresh(patObj)
     return patObj
 
+# Delete the patients matching a filter with set-based statements, caller commits
+# Releases their rooms and drops their treatments first
+def _delete_pats(pat_filter, db : _orm.Session):
+    pat_ids = _sql.select(_models.Patient.id).where(pat_filter)
+    ro_ids = _sql.select(_models.Patient.admitted_to).where(pat_filter, _models.Patient.admitted_to != 0)
+
+    db.query(_models.Room).filter(_models.Room.id.in_(ro_ids)).update({_models.Room.occupied : False, _models.Room.occupied_by : 0}, synchronize_session = False)
+    db.query(_models.Treatment).filter(_models.Treatment.billed_to.in_(pat_ids)).delete(synchronize_session = False)
+    db.query(_models.Patient).filter(pat_filter).delete(synchronize_session = False)
+
 # Delete pat
-async def delete_pat(pat_id : int , db : _orm.Session):
-    pat_db =  await get_pat_by_id(pat_id, db)
+@_run_in_pool
+def delete_pat(pat_id : int , db : _orm.Session):
+    pat_db = db.query(_models.Patient).filter(_models.Patient.id == pat_id).first()
+
+    if pat_db is None:
+        raise _fastapi.HTTPException(status_code=404, detail = "Patient ID not found in database!")
+
+    ro_id = pat_db.admitted_to
+    _delete_pats(_models.Patient.id == pat_id, db)
+    db.commit()
+
+    _cache.entities.invalidate("patients", pat_id)
+    if ro_id:
+        _cache.entities.invalidate("rooms", ro_id)
+
+# Get pats by name
+@_run_in_pool
+def get_pats_by_name(pat_name : str, db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _search(_models.Patient, _schemas.Patient, "name", pat_name, db, after_id, limit)
+
+# Stream all pats (or only admitted ones) through a server-side cursor, consumed lazily by the template
+# admitted=True yields only admitted patients with their rooms, loaded by the same joined query
+def iter_pats(db : _orm.Session, admitted : bool = False):
+    if not admitted:
+        items = db.query(_models.Patient).order_by(_models.Patient.id).yield_per(STREAM_BATCH)
+        return map(_schemas.Patient.from_orm, items)
+
+    items = db.query(_models.Patient).join(_models.Patient.room).options(_orm.contains_eager(_models.Patient.room))
+    items = items.filter(_models.Patient.admitted_to != 0).order_by(_models.Patient.id).yield_per(STREAM_BATCH)
+    return map(_schemas.AdmittedPatient.from_orm, items)
+
+# Get one page of pats
+@_run_in_pool
+def get_pats_page(db : _orm.Session, after_id : int = 0, limit : int = PAGE_SIZE):
+    return _get_page(_models.Patient, _schemas.Patient, db, after_id, limit)
+
+
+
+
+
+#*********************************************************
+
+# TREATMENTS
+
+#*********************************************************
+
+# Bill new treatment
+@_run_in_pool
+def create_trt(trt : _schemas._TreatmentCreate, db : _orm.Session):
+
+    # New treatment object
+    trtObj = _models.Treatment(
+        name = trt.name,
+        cost = trt.cost,
+        billed_to = trt.billed_to
+    )
+
+    # Write to db
+    db.add(trtObj)
+    db.commit()
+    db.refresh(trtObj)
+    return trtObj
+
+# Patient with its treatments, their total and count in one query, the aggregates are window functions
+# over the rows, so they always match the listed treatments. Returns (patient, treatments, total, count),
+# None if the patient is missing
+@_run_in_pool
+def get_pat_bills(pat_id : int, db : _orm.Session):
+    total = _sql.func.coalesce(_sql.func.sum(_models.Treatment.cost).over(), 0)
+    count = _sql.func.count(_models.Treatment.id).over()
+    rows = db.query(_models.Patient, _models.Treatment, total, count).outerjoin(_models.Treatment, _models.Treatment.billed_to == _models.Patient.id).filter(_models.Patient.id == pat_id).order_by(_models.Treatment.id).all()
+    if not rows:
+        return None
+
+    treatments = [_schemas.Treatment.from_orm(row[1]) for row in rows if row[1] is not None]
+    return _schemas.Patient.from_orm(rows[0][0]), treatments, rows[0][2], rows[0][3]
+
+# Billing totals for all patients in one GROUP BY query, keyset paginated
+# sort is "amount" (largest first), "amount_asc" or "patient", the cursor is "total,patient_id" for amount sorts and "patient_id" otherwise
+BILL_REPORT_SORTS = ("amount", "amount_asc", "patient")
+
+@_run_in_pool
+def get_bill_report(db : _orm.Session, sort : str = "amount", after : str = "", limit : int = PAGE_SIZE):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    pat_id = _models.Treatment.billed_to
+    count = _sql.func.count(_models.Treatment.id)
+    total = _sql.func.coalesce(_sql.func.sum(_models.Treatment.cost), 0)
+
+    items = db.query(pat_id, _models.Patient.name, count, total).join(_models.Patient, _models.Patient.id == pat_id).group_by(pat_id, _models.Patient.name)
+
+    if sort == "patient":
+        if after:
+            items = items.filter(pat_id > int(after))
+        items = items.order_by(pat_id)
+    else:
+        if after:
+            after_total, after_id = map(int, after.split(","))
+            beyond = total < after_total if sort == "amount" else total > after_total
+            items = items.having(_sql.or_(beyond, _sql.and_(total == after_total, pat_id > after_id)))
+        items = items.order_by(total.desc() if sort == "amount" else total, pat_id)
+
+    rows = items.limit(limit + 1).all()
+    report = [_schemas.BillTotal(patient_id = row[0], patient_name = row[1], count = row[2], total = row[3]) for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = report[-1]
+        next_cursor = str(last.patient_id) if sort == "patient" else str(last.total) + "," + str(last.patient_id)
+
+    return report, next_cursor
+
+
+
+
+#*********************************************************
+
+# ADMISSION
+
+#*********************************************************
+
+# Drop the cached patient and room after an admission or discharge
+def _invalidate_admission(pat_id : int, ro_id : int):
+    _cache.entities.invalidate("patients", pat_id)
+    _cache.entities.invalidate("rooms", ro_id)
+
+# Patient and room for the admission confirm page in one query, 404 if either is missing
+@_run_in_pool
+def get_pat_and_ro(pat_id : int, ro_id : int, db : _orm.Session):
+    row = db.query(_models.Patient, _models.Room).outerjoin(_models.Room, _models.Room.id == ro_id).filter(_models.Patient.id == pat_id).first()
+
+    if row is None:
+        raise _fastapi.HTTPException(status_code=404, detail = "Patient ID not found in database!")
+    if row[1] is None:
+        raise _fastapi.HTTPException(status_code=404, detail = "Room ID not found in database!")
+
+    return _schemas.Patient.from_orm(row[0]), _schemas.Room.from_orm(row[1])
+
+# Admitted patient with its room for the discharge confirm page in one joined query
+@_run_in_pool
+def get_admitted_pat(pat_id : int, db : _orm.Session):
+    pat_db = db.query(_models.Patient).options(_orm.joinedload(_models.Patient.room, innerjoin = True)).filter(_models.Patient.id == pat_id, _models.Patient.admitted_to != 0).first()
+
+    if pat_db is None:
+        raise _fastapi.HTTPException(status_code=404, detail = "Patient is not admitted to any room!")
+
+    return _schemas.AdmittedPatient.from_orm(pat_db)
+
+# Admit patient to room, returns both rows
+# State checks read the database directly, never the cache
+# Room and patient are claimed with compare-and-set UPDATEs, a concurrent admission of either one gets a 409
+@_run_in_pool
+def admit_pat(pat_id : int, ro_id : int, db : _orm.Session):
+    claimed = db.query(_models.Room).filter(_models.Room.id == ro_id, _models.Room.occupied == False).update({_models.Room.occupied : True, _models.Room.occupied_by : pat_id}, synchronize_session = False)
+
+    if not claimed:
+        db.rollback()
+        ro_db = db.query(_models.Room).filter(_models.Room.id == ro_id).first()
+        if ro_db is None:
+            raise _fastapi.HTTPException(status_code=404, detail = "Room ID not found in database!")
+        raise _fastapi.HTTPException(status_code=409, detail = "Room " + ro_db.name + " is already occupied by patient " + str(ro_db.occupied_by) + "!")
+
+    admitted = db.query(_models.Patient).filter(_models.Patient.id == pat_id, _models.Patient.admitted_to == 0).update({_models.Patient.admitted_to : ro_id}, synchronize_session = False)
+
+    if not admitted:
+        db.rollback()
+        pat_db = db.query(_models.Patient).filter(_models.Patient.id == pat_id).first()
+        if pat_db is None:
+            raise _fastapi.HTTPException(status_code=404, detail = "Patient ID not found in database!")
+        raise _fastapi.HTTPException(status_code=409, detail = "Patient " + pat_db.name + " is already admitted to room " + str(pat_db.admitted_to) + "!")
+
+    db.commit()
+    _invalidate_admission(pat_id, ro_id)
+    return get_pat_by_id.sync(pat_id, db), get_ro_by_id.sync(ro_id, db)
+
+# Admit patient to the smallest free room of at least min_size in one transaction, returns both rows
+# The free room lookup is a range scan on the (occupied, size) index
+@_run_in_pool
+def allocate_ro(pat_id : int, min_size : int, db : _orm.Session):
+    pat_db = db.query(_models.Patient).filter(_models.Patient.id == pat_id).first()
 
     if pat_db is None:
         raise _fastapi.HTTPException(status_code=404, detail = "Patient ID not found in database!")
 
     if pat_db.admitted_to:
-        ro_id = pat_db.admitted_to
-        ro_db = await get_ro_by_id(ro_id, db)
+        raise _fastapi.HTTPException(status_code=409, detail = "Patient is already admitted to room " + str(pat_db.admitted_to) + "!")
 
-        ro_db.occupied = False
-        ro_db.occupied_by = 0
-        
-        db.commit()
-        db.refresh(ro_db)
+    # Claim the best fit, if another admission takes it first try the next one
+    while True:
+        ro_id = db.query(_models.Room.id).filter(_models.Room.occupied == False, _models.Room.size >= min_size).order_by(_models.Room.size, _models.Room.id).limit(1).scalar()
+
+        if ro_id is None:
+            db.rollback()
+            raise _fastapi.HTTPException(status_code=409, detail = "No free room of size " + str(min_size) + " or larger!")
+
+        claimed = db.query(_models.Room).filter(_models.Room.id == ro_id, _models.Room.occupied == False).update({_models.Room.occupied : True, _models.Room.occupied_by : pat_id}, synchronize_session = False)
+        if claimed:
+            break
+
+    # Patient may have been admitted elsewhere meanwhile
+    admitted = db.query(_models.Patient).filter(_models.Patient.id == pat_id, _models.Patient.admitted_to == 0).update({_models.Patient.admitted_to : ro_id}, synchronize_session = False)
+    if not admitted:
+        db.rollback()
+        raise _fastapi.HTTPException(status_code=409, detail = "Patient is already admitted to a room!")
 
-    db.delete(pat_db)
     db.commit()
+    _invalidate_admission(pat_id, ro_id)
+    return get_pat_by_id.sync(pat_id, db), get_ro_by_id.sync(ro_id, db)
 
-# Get pats by name
-async def get_pats_by_name(pat_name : str, db : _orm.Session):
-    items = db.query(_models.Patient).filter(_models.Patient.name.contains(pat_name))
-    return list(map(_schemas.Patient.from_orm, items))
+# Discharge patient from their room, returns both rows
+# The patient is released with a compare-and-set on the room read, a concurrent discharge gets a 409
+@_run_in_pool
+def discharge_pat(pat_id : int, db : _orm.Session):
+    pat_db = db.query(_models.Patient).filter(_models.Patient.id == pat_id).first()
+
+    if pat_db is None:
+        raise _fastapi.HTTPException(status_code=404, detail = "Patient ID not found in database!")
+
+    ro_id = pat_db.admitted_to
+    if not ro_id:
+        raise _fastapi.HTTPException(status_code=409, detail = "Patient " + pat_db.name + " is not admitted to a room!")
+
+    released = db.query(_models.Patient).filter(_models.Patient.id == pat_id, _models.Patient.admitted_to == ro_id).update({_models.Patient.admitted_to : 0}, synchronize_session = False)
+
+    if not released:
+        db.rollback()
+        raise _fastapi.HTTPException(status_code=409, detail = "Patient " + pat_db.name + " was discharged by another request!")
+
+    db.query(_models.Room).filter(_models.Room.id == ro_id, _models.Room.occupied_by == pat_id).update({_models.Room.occupied : False, _models.Room.occupied_by : 0}, synchronize_session = False)
+
+    db.commit()
+    _invalidate_admission(pat_id, ro_id)
+    return get_pat_by_id.sync(pat_id, db), get_ro_by_id.sync(ro_id, db)
+
+BATCH_MAX = 1000  # Items per admission batch
+
+# Apply many discharges and admissions in one transaction, returns a result per item and whether anything was written
+# Discharges go first so a batch can move patients between rooms. Every item is checked against the occupancy
+# read once for the whole batch and updated by the earlier items, then all changes are written with four
+# executemany compare-and-set UPDATEs. If a concurrent request changed one of the rows in between, nothing is written.
+# atomic=True writes nothing unless every item is valid.
+@_run_in_pool
+def apply_admissions(admissions : list, discharges : list, db : _orm.Session, atomic : bool = False):
+    pat_ids = set(discharges) | {pat_id for pat_id, _ in admissions}
+    pats = {pat.id : pat for pat in db.query(_models.Patient.id, _models.Patient.name, _models.Patient.admitted_to).filter(_models.Patient.id.in_(pat_ids))}
+    admitted_to = {pat_id : pat.admitted_to for pat_id, pat in pats.items()}
+
+    ro_ids = {ro_id for _, ro_id in admissions} | {admitted_to[pat_id] for pat_id in discharges if admitted_to.get(pat_id)}
+    ros = {ro.id : ro for ro in db.query(_models.Room.id, _models.Room.name, _models.Room.occupied, _models.Room.occupied_by).filter(_models.Room.id.in_(ro_ids))}
+    occupied = {ro_id : ro.occupied for ro_id, ro in ros.items()}
+    occupied_by = {ro_id : ro.occupied_by for ro_id, ro in ros.items()}
+
+    results = []
+    released, freed, claimed, admitted = [], [], [], []
+
+    def result(action, pat_id, ro_id, status, detail):
+        results.append({"action" : action, "patient_id" : pat_id, "room_id" : ro_id, "status" : status, "detail" : detail})
+
+    for pat_id in discharges:
+        ro_id = admitted_to.get(pat_id)
+        if pat_id not in pats:
+            result("discharge", pat_id, None, 404, "Patient ID not found in database!")
+        elif not ro_id:
+            result("discharge", pat_id, None, 409, "Patient " + pats[pat_id].name + " is not admitted to a room!")
+        else:
+            released.append({"pat_id" : pat_id, "ro_id" : ro_id})
+            admitted_to[pat_id] = 0
+            if occupied_by.get(ro_id) == pat_id:
+                freed.append({"pat_id" : pat_id, "ro_id" : ro_id})
+                occupied[ro_id] = False
+                occupied_by[ro_id] = 0
+            result("discharge", pat_id, ro_id, 200, "Discharged " + pats[pat_id].name + "!")
+
+    for pat_id, ro_id in admissions:
+        if ro_id not in ros:
+            result("admit", pat_id, ro_id, 404, "Room ID not found in database!")
+        elif pat_id not in pats:
+            result("admit", pat_id, ro_id, 404, "Patient ID not found in database!")
+        elif occupied[ro_id]:
+            result("admit", pat_id, ro_id, 409, "Room " + ros[ro_id].name + " is already occupied by patient " + str(occupied_by[ro_id]) + "!")
+        elif admitted_to[pat_id]:
+            result("admit", pat_id, ro_id, 409, "Patient " + pats[pat_id].name + " is already admitted to room " + str(admitted_to[pat_id]) + "!")
+        else:
+            claimed.append({"pat_id" : pat_id, "ro_id" : ro_id})
+            admitted.append({"pat_id" : pat_id, "ro_id" : ro_id})
+            occupied[ro_id] = True
+            occupied_by[ro_id] = pat_id
+            admitted_to[pat_id] = ro_id
+            result("admit", pat_id, ro_id, 200, "Admitted " + pats[pat_id].name + " to " + ros[ro_id].name + "!")
+
+    failed = any(item["status"] != 200 for item in results)
+    if atomic and failed:
+        for item in results:
+            if item["status"] == 200:
+                item["status"], item["detail"] = 409, "Not applied, the batch was rejected!"
+
+    if not (released or admitted) or (atomic and failed):
+        db.rollback()
+        return results, False
+
+    pat_id, ro_id = _sql.bindparam("pat_id"), _sql.bindparam("ro_id")
+    Patient, Room = _models.Patient.__table__, _models.Room.__table__
+    steps = [
+        (Patient.update().where(Patient.c.id == pat_id, Patient.c.admitted_to == ro_id).values(admitted_to = 0), released),
+        (Room.update().where(Room.c.id == ro_id, Room.c.occupied_by == pat_id).values(occupied = False, occupied_by = 0), freed),
+        (Room.update().where(Room.c.id == ro_id, Room.c.occupied == False).values(occupied = True, occupied_by = pat_id), claimed),
+        (Patient.update().where(Patient.c.id == pat_id, Patient.c.admitted_to == 0).values(admitted_to = ro_id), admitted),
+    ]
+
+    for statement, params in steps:
+        if params and db.execute(statement, params).rowcount != len(params):
+            db.rollback()
+            raise _fastapi.HTTPException(status_code=409, detail = "Occupancy changed during the batch, nothing was applied!")
+
+    db.commit()
+    for item in released + admitted:
+        _invalidate_admission(item["pat_id"], item["ro_id"])
+    return results, True
+
+
+
+
+#*********************************************************
 
-# Get all pats
-async def get_pats(db : _orm.Session):
-    items = db.query(_models.Patient).filter(_models.Patient.name.contains(''))
-    return list(map(_schemas.Patient.from_orm, items))
+# BULK IMPORT
+
+#*********************************************************
+
+IMPORT_CHUNK = 1000         # Rows validated and inserted per transaction
+IMPORT_MAX_ERRORS = 1000    # Row errors listed in the report, the rest are only counted
+
+# Importable tables with their create schema
+IMPORT_SCHEMAS = {
+    "doctors" : (_models.Doctor, _schemas._DoctorCreate),
+    "nurses" : (_models.Nurse, _schemas._NurseCreate),
+    "services" : (_models.Service, _schemas._ServiceCreate),
+    "rooms" : (_models.Room, _schemas._RoomCreate),
+    "patients" : (_models.Patient, _schemas._PatientCreate),
+    "treatments" : (_models.Treatment, _schemas._TreatmentCreate),
+}
+
+# Foreign key columns checked before insert
+IMPORT_REFERENCES = {
+    "patients" : ("treated_by", _models.Doctor),
+    "treatments" : ("billed_to", _models.Patient),
+}
+
+# Split a byte stream into byte lines, without the UTF-8 BOM spreadsheet exports start with
+async def _iter_lines(stream):
+    buf = b""
+    first = True
+    async for chunk in stream:
+        buf += chunk
+        if first and (len(buf) >= 3 or b"\n" in buf):
+            buf = buf[3:] if buf.startswith(b"\xef\xbb\xbf") else buf
+            first = False
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            yield line
+
+    if buf:
+        yield buf[3:] if first and buf.startswith(b"\xef\xbb\xbf") else buf
+
+# Parse CSV (header row first) or NDJSON lines into (row number, dict or error message)
+async def _iter_records(stream, format : str):
+    header = None
+    pending = ""
+    row = 0
+
+    async for raw in _iter_lines(stream):
+        try:
+            line = raw.decode("utf-8").rstrip("\r")
+        except UnicodeDecodeError as e:
+            # A CSV without a readable header has no rows to report
+            if format == "csv" and header is None:
+                yield 0, "Header is not valid UTF-8: " + str(e)
+                return
+            row += 1
+            pending = ""
+            yield row, "Invalid UTF-8: " + str(e)
+            continue
+
+        if format == "ndjson":
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                record = _json.loads(line)
+            except ValueError as e:
+                yield row, "Invalid JSON: " + str(e)
+                continue
+            yield row, record if isinstance(record, dict) else "Row is not a JSON object"
+            continue
+
+        # Quoted CSV fields may span lines, wait for the closing quote
+        pending = pending + "\n" + line if pending else line
+        if pending.count('"') % 2:
+            continue
+        line, pending = pending, ""
+
+        if not line.strip():
+            continue
+        values = next(_csv.reader([line]))
+
+        if header is None:
+            header = [col.strip() for col in values]
+            continue
+
+        row += 1
+        if len(values) != len(header):
+            yield row, "Expected " + str(len(header)) + " columns, got " + str(len(values))
+            continue
+        yield row, dict(zip(header, values))
+
+    if pending:
+        yield row + 1, "Unterminated quoted field"
+
+# Validate and insert one chunk of records in a single transaction, returns (inserted, errors)
+@_run_in_pool
+def import_chunk(table : str, records : list, db : _orm.Session):
+    model, schema = IMPORT_SCHEMAS[table]
+    valid = []
+    errors = []
+
+    for row, record in records:
+        if isinstance(record, str):
+            errors.append({"row" : row, "error" : record})
+            continue
+        try:
+            valid.append((row, schema(**record).dict()))
+        except _pydantic.ValidationError as e:
+            errors.append({"row" : row, "error" : "; ".join(".".join(map(str, err["loc"])) + ": " + err["msg"] for err in e.errors())})
+
+    # Drop rows pointing at missing doctors / patients
+    if table in IMPORT_REFERENCES and valid:
+        column, ref_model = IMPORT_REFERENCES[table]
+        ids = {values[column] for _, values in valid}
+        found = {ref_id for ref_id, in db.query(ref_model.id).filter(ref_model.id.in_(ids))}
+        errors.extend({"row" : row, "error" : column + ": " + str(values[column]) + " not found in database"} for row, values in valid if values[column] not in found)
+        valid = [(row, values) for row, values in valid if values[column] in found]
+
+    if not valid:
+        return 0, errors
+
+    # One executemany for the chunk, row by row only if it fails to find the culprits
+    try:
+        db.execute(_sql.insert(model), [values for _, values in valid])
+        db.commit()
+        return len(valid), errors
+    except _sql.exc.SQLAlchemyError:
+        db.rollback()
+
+    inserted = 0
+    for row, values in valid:
+        try:
+            db.execute(_sql.insert(model), values)
+            db.commit()
+            inserted += 1
+        except _sql.exc.SQLAlchemyError as e:
+            db.rollback()
+            errors.append({"row" : row, "error" : str(e.orig if hasattr(e, "orig") else e)})
+
+    return inserted, errors
+
+# Import a CSV / NDJSON byte stream into a table chunk by chunk
+async def import_rows(table : str, format : str, stream, db : _orm.Session):
+    report = {"table" : table, "rows" : 0, "inserted" : 0, "failed" : 0, "errors" : []}
+    chunk = []
+
+    async def flush():
+        inserted, errors = await import_chunk(table, chunk, db)
+        errors.sort(key = lambda err : err["row"])
+        report["rows"] += len(chunk)
+        report["inserted"] += inserted
+        report["failed"] += len(errors)
+        report["errors"].extend(errors[:IMPORT_MAX_ERRORS - len(report["errors"])])
+        chunk.clear()
+
+    async for record in _iter_records(stream, format):
+        chunk.append(record)
+        if len(chunk) >= IMPORT_CHUNK:
+            await flush()
+
+    if chunk:
+        await flush()
+
+    return report
+
+
+
+#*********************************************************
+
+# EXPORT
+
+#*********************************************************
+
+EXPORT_BATCH = 1000  # Rows fetched from the cursor and sent per chunk
+
+# Exportable tables with their columns in output order
+EXPORT_COLUMNS = {
+    "treatments" : ("id", "name", "cost", "billed_to"),
+    "patients" : ("id", "name", "history", "treated_by", "admitted_to"),
+    "rooms" : ("id", "name", "size", "occupied", "occupied_by"),
+}
+EXPORT_MODELS = {"treatments" : _models.Treatment, "patients" : _models.Patient, "rooms" : _models.Room}
+
+# Filters accepted per table, None values are ignored
+EXPORT_FILTERS = {
+    "treatments" : ("patient", "doctor", "min_cost", "max_cost"),
+    "patients" : ("doctor",),
+    "rooms" : (),
+}
+
+def _export_query(table : str, filters : dict):
+    model = EXPORT_MODELS[table]
+    query = _sql.select(*(getattr(model, col) for col in EXPORT_COLUMNS[table])).order_by(model.id)
+
+    if filters.get("patient") is not None:
+        query = query.where(model.billed_to == filters["patient"])
+    if filters.get("doctor") is not None:
+        if table == "treatments":
+            query = query.join(_models.Patient, _models.Patient.id == model.billed_to).where(_models.Patient.treated_by == filters["doctor"])
+        else:
+            query = query.where(model.treated_by == filters["doctor"])
+    if filters.get("min_cost") is not None:
+        query = query.where(model.cost >= filters["min_cost"])
+    if filters.get("max_cost") is not None:
+        query = query.where(model.cost <= filters["max_cost"])
+
+    return query
+
+# Rows of a table as CSV (with header row) or NDJSON text chunks, read through a server side cursor
+# A sync generator, so the streaming response pulls it in the thread pool and memory stays at one batch
+def iter_export(table : str, format : str, db : _orm.Session, **filters):
+    columns = EXPORT_COLUMNS[table]
+    result = db.connection().execution_options(stream_results = True).execute(_export_query(table, filters))
+
+    if format == "csv":
+        buf = _io.StringIO()
+        writer = _csv.writer(buf)
+        writer.writerow(columns)
+
+        for rows in result.partitions(EXPORT_BATCH):
+            writer.writerows(rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+        if buf.tell():
+            yield buf.getvalue()
+    else:
+        for rows in result.partitions(EXPORT_BATCH):
+            yield b"".join(_orjson.dumps(dict(zip(columns, row))) + b"\n" for row in rows)
+
+
+
+
+#*********************************************************
+
+# MESSAGES
+
+#*********************************************************
+
+# Convert a stored message to its schema, dates are shown in local time
+def _msg_from_orm(msg : _models.Message):
+    mes = _schemas.Message.from_orm(msg)
+    mes.date = mes.date.replace(tzinfo=from_zone).astimezone(to_zone)
+    return mes
+
+# Store new message, a reply joins the thread of its parent, anything else starts a thread
+@_run_in_pool
+def create_msg(msg : _schemas._MessageCreate, db : _orm.Session):
+
+    parent = None
+    if msg.parent_id is not None:
+        parent = db.query(_models.Message).filter(_models.Message.id == msg.parent_id).first()
+        if parent is None:
+            raise _fastapi.HTTPException(status_code=404, detail="Message to reply to does not exist!")
+        if msg.sender not in (parent.sender, parent.receiver):
+            raise _fastapi.HTTPException(status_code=403, detail="Cannot reply to a conversation of another user!")
+
+    # New message object
+    msgObj = _models.Message(
+        sender = msg.sender,
+        receiver = msg.receiver,
+        subject = msg.subject,
+        content = msg.content,
+        parent_id = msg.parent_id,
+        thread_id = parent.thread_id if parent is not None else None
+    )
+
+    # Message and thread are written in the same transaction
+    db.add(msgObj)
+    db.flush()
+
+    if parent is None:
+        msgObj.thread_id = msgObj.id
+        db.add(_models.Thread(
+            id = msgObj.id,
+            guest = msg.receiver if msg.sender == "Admin" else msg.sender,
+            subject = msg.subject,
+            last_message_id = msgObj.id,
+            last_date = msgObj.date,
+            messages = 1
+        ))
+    else:
+        db.query(_models.Thread).filter(_models.Thread.id == msgObj.thread_id).update({
+            _models.Thread.last_message_id : msgObj.id,
+            _models.Thread.last_date : msgObj.date,
+            _models.Thread.messages : _models.Thread.messages + 1,
+        }, synchronize_session = False)
+
+    db.commit()
+    db.refresh(msgObj)
+    return _msg_from_orm(msgObj)
+
+# Page of messages newest first, before is the cursor returned with the previous page
+def _msg_page(items, before : int, limit : int):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    if before:
+        items = items.filter(_models.Message.id < before)
+    items = items.order_by(_models.Message.id.desc()).limit(limit + 1).all()
+    next_before = items[limit - 1].id if len(items) > limit else None
+    return list(map(_msg_from_orm, items[:limit])), next_before
+
+# Messages sent to a user, newest first, a range scan of the receiver index (SQLite appends the id to it)
+@_run_in_pool
+def get_msgs_to(receiver : str, db : _orm.Session, before : int = 0, limit : int = PAGE_SIZE):
+    return _msg_page(db.query(_models.Message).filter(_models.Message.receiver == receiver), before, limit)
+
+# Messages stored after a given id, oldest first, for the push poller
+@_run_in_pool
+def get_msgs_after(after_id : int, db : _orm.Session, limit : int = MAX_PAGE_SIZE):
+    items = db.query(_models.Message).filter(_models.Message.id > after_id).order_by(_models.Message.id).limit(limit)
+    return list(map(_msg_from_orm, items))
+
+# Id of the newest message, 0 on an empty board
+@_run_in_pool
+def get_last_msg_id(db : _orm.Session):
+    return db.query(_sql.func.coalesce(_sql.func.max(_models.Message.id), 0)).scalar()
+
+# Messages sent or received by a user, newest first, served by the sender and receiver indexes
+@_run_in_pool
+def get_msgs_of(name : str, db : _orm.Session, before : int = 0, limit : int = PAGE_SIZE):
+    return _msg_page(db.query(_models.Message).filter(_sql.or_(_models.Message.sender == name, _models.Message.receiver == name)), before, limit)
+
+# Messages of a thread oldest first, a range scan of the thread index, None if the thread does not exist
+@_run_in_pool
+def get_thread(thread_id : int, db : _orm.Session):
+    thread = db.query(_models.Thread).filter(_models.Thread.id == thread_id).first()
+    if thread is None:
+        return None
+
+    items = db.query(_models.Message).filter(_models.Message.thread_id == thread_id).order_by(_models.Message.id)
+    return _thread_from_orm(thread), list(map(_msg_from_orm, items))
+
+# Threads with the latest activity first, paged by the id of their newest message
+@_run_in_pool
+def get_threads(db : _orm.Session, before : int = 0, limit : int = PAGE_SIZE):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    items = db.query(_models.Thread)
+    if before:
+        items = items.filter(_models.Thread.last_message_id < before)
+    items = items.order_by(_models.Thread.last_message_id.desc()).limit(limit + 1).all()
+    next_before = items[limit - 1].last_message_id if len(items) > limit else None
+    return list(map(_thread_from_orm, items[:limit])), next_before
+
+def _thread_from_orm(thread : _models.Thread):
+    item = _schemas.Thread.from_orm(thread)
+    item.last_date = item.last_date.replace(tzinfo=from_zone).astimezone(to_zone)
+    return item
+
+# Messages matching every word of the query, best match first
+# Ranking reads the index entries of the query words only, so the cost grows with the matches, not the board
+@_run_in_pool
+def search_msgs(query : str, db : _orm.Session, limit : int = PAGE_SIZE):
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    words = _re.findall(r"\w+", query)
+    if not words:
+        return []
+
+    if _database.engine.dialect.name != "sqlite":
+        items = db.query(_models.Message)
+        for word in words:
+            items = items.filter(_sql.or_(_models.Message.subject.contains(word), _models.Message.content.contains(word)))
+        return list(map(_msg_from_orm, items.order_by(_models.Message.id.desc()).limit(limit)))
+
+    match = " ".join('"' + word + '"' for word in words)
+    weights = ", ".join(map(str, MESSAGE_SEARCH_WEIGHTS))
+    ids = db.execute(_sql.text(f"SELECT rowid FROM messages_fts WHERE messages_fts MATCH :match ORDER BY bm25(messages_fts, {weights}), rowid DESC LIMIT :limit"), {"match" : match, "limit" : limit}).scalars().all()
+
+    items = {mes.id : mes for mes in db.query(_models.Message).filter(_models.Message.id.in_(ids))}
+    return [_msg_from_orm(items[mes_id]) for mes_id in ids]
+
+# Message retention, 0 keeps everything
+MESSAGE_MAX_AGE_DAYS = float(_os.environ.get("HADMDB_MESSAGE_MAX_AGE_DAYS", 0))  # Delete messages older than this
+MESSAGE_MAX_PER_GUEST = int(_os.environ.get("HADMDB_MESSAGE_MAX_PER_GUEST", 0))  # Keep the newest messages of each guest conversation
+COMPACT_INTERVAL = float(_os.environ.get("HADMDB_COMPACT_INTERVAL", 3600))       # Seconds between compaction runs
+COMPACT_BATCH = 5000  # Messages deleted per transaction, short write locks for the other requests
+
+# Delete in batches of ids from a select, returns the count deleted
+def _delete_msgs(db : _orm.Session, ids):
+    deleted = 0
+    while True:
+        count = db.query(_models.Message).filter(_models.Message.id.in_(ids.limit(COMPACT_BATCH).scalar_subquery())).delete(synchronize_session = False)
+        db.commit()
+        deleted += count
+        if count < COMPACT_BATCH:
+            return deleted
+
+# Delete a list of message ids in batches, returns the count deleted
+def _delete_msg_ids(db : _orm.Session, ids : list):
+    deleted = 0
+    for start in range(0, len(ids), COMPACT_BATCH):
+        deleted += db.query(_models.Message).filter(_models.Message.id.in_(ids[start:start + COMPACT_BATCH])).delete(synchronize_session = False)
+        db.commit()
+    return deleted
+
+# Enforce the retention policy, returns the number of messages deleted by age and by count
+# Idempotent, so every worker may run it
+@_run_in_pool
+def compact_msgs(db : _orm.Session, max_age_days : float = MESSAGE_MAX_AGE_DAYS, max_per_guest : int = MESSAGE_MAX_PER_GUEST):
+    report = {"age" : 0, "count" : 0}
+
+    if max_age_days > 0:
+        cutoff = _dt.datetime.utcnow() - _dt.timedelta(days = max_age_days)
+        report["age"] = _delete_msgs(db, _sql.select(_models.Message.id).where(_models.Message.date < cutoff))
+
+    if max_per_guest > 0:
+        # A conversation is everything between one guest and Admin, ranked newest first
+        # The ranking sorts the whole board, so it runs once and the ids are deleted in batches
+        guest = _sql.case((_models.Message.sender == "Admin", _models.Message.receiver), else_ = _models.Message.sender)
+        rank = _sql.func.row_number().over(partition_by = guest, order_by = _models.Message.id.desc())
+        ranked = _sql.select(_models.Message.id.label("id"), rank.label("rank")).subquery()
+        ids = db.execute(_sql.select(ranked.c.id).where(ranked.c.rank > max_per_guest)).scalars().all()
+        db.commit()
+        report["count"] = _delete_msg_ids(db, ids)
+
+    # Oldest messages go first, so only the thread sizes change and emptied threads are removed
+    if report["age"] or report["count"]:
+        remaining = _sql.select(_sql.func.count()).where(_models.Message.thread_id == _models.Thread.id).scalar_subquery()
+        db.query(_models.Thread).update({_models.Thread.messages : remaining}, synchronize_session = False)
+        db.query(_models.Thread).filter(_models.Thread.messages == 0).delete(synchronize_session = False)
+        db.commit()
 
+    return report
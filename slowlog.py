@@ -0,0 +1,110 @@
+# Slow query log with the query plan of every slow statement
+#
+# @zgr2788
+#
+# Settings come from the environment (or the .env file loaded by database.py):
+#   HADMDB_SLOW_QUERY_MS        threshold in milliseconds, 0 turns the log off (default 100)
+#   HADMDB_SLOW_QUERY_LOG       log file, one JSON object per line (default ./slow-queries.log)
+#   HADMDB_SLOW_QUERY_BYTES     size at which the log rotates (default 10 MB)
+#   HADMDB_SLOW_QUERY_BACKUPS   rotated files kept (default 5)
+#
+# Every statement over the threshold is logged with its bound parameters, the route that ran it
+# (needs the metrics middleware, HADMDB_METRICS=on) and, on SQLite, its EXPLAIN QUERY PLAN.
+# Plans scanning a table without an index are flagged as full scans. The latest entries are
+# also kept in memory for /debug/slow-queries.
+#
+# Parameters can hold patient data, keep the log file as private as the database.
+
+import collections as _collections
+import datetime as _dt
+import json as _json
+import logging as _logging
+import logging.handlers as _handlers
+import os as _os
+import threading as _threading
+import time as _time
+import metrics as _metrics
+
+SLOW_QUERY_MS = float(_os.environ.get("HADMDB_SLOW_QUERY_MS", 100))
+SLOW_QUERY_LOG = _os.environ.get("HADMDB_SLOW_QUERY_LOG", "./slow-queries.log")
+SLOW_QUERY_BYTES = int(_os.environ.get("HADMDB_SLOW_QUERY_BYTES", 10 * 1024 * 1024))
+SLOW_QUERY_BACKUPS = int(_os.environ.get("HADMDB_SLOW_QUERY_BACKUPS", 5))
+
+RECENT = 200      # Entries kept for the debug page
+MAX_PARAMS = 500  # Characters of the bound parameters kept per entry
+
+_recent = _collections.deque(maxlen = RECENT)
+_lock = _threading.Lock()
+_logger = _logging.getLogger("hadmdb.slow_queries")
+_logger.propagate = False
+
+
+# Plan rows of a statement, on the same connection so temp tables and pragmas match
+def _explain(conn, statement, parameters):
+    if conn.dialect.name != "sqlite":
+        return []
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        return [row[3] for row in cursor.fetchall()]
+    except Exception as e:
+        return ["EXPLAIN failed: " + str(e)]
+    finally:
+        cursor.close()
+
+# SCAN without an index is a full table scan, SCAN ... USING INDEX walks a whole index
+def _full_scan(plan : list):
+    return any(step.startswith("SCAN ") and " USING " not in step for step in plan)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("hadmdb_slow_start", []).append(_time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = (_time.perf_counter() - conn.info["hadmdb_slow_start"].pop()) * 1000
+    if elapsed < SLOW_QUERY_MS:
+        return
+
+    # executemany runs one statement per parameter set, the first one stands for all
+    first = parameters[0] if executemany and parameters else parameters
+    plan = _explain(conn, statement, first)
+    request = _metrics.current_request()
+
+    record(
+        ms = round(elapsed, 3),
+        statement = statement,
+        parameters = repr(parameters)[:MAX_PARAMS],
+        executemany = executemany,
+        route = " ".join(request[:2]) if request else None,
+        path = request[2] if request else None,
+        plan = plan,
+        full_scan = _full_scan(plan),
+    )
+
+def record(**entry):
+    entry = dict(time = _dt.datetime.utcnow().isoformat(timespec = "milliseconds"), **entry)
+    with _lock:
+        _recent.appendleft(entry)
+    _logger.warning(_json.dumps(entry, default = str))
+
+# Latest slow statements, newest first
+def recent():
+    with _lock:
+        return list(_recent)
+
+
+# Log statements on the engine slower than the threshold
+def instrument_engine(engine):
+    if SLOW_QUERY_MS <= 0:
+        return
+
+    import sqlalchemy as _sql
+
+    if SLOW_QUERY_LOG and not _logger.handlers:
+        handler = _handlers.RotatingFileHandler(SLOW_QUERY_LOG, maxBytes = SLOW_QUERY_BYTES, backupCount = SLOW_QUERY_BACKUPS)
+        handler.setFormatter(_logging.Formatter("%(message)s"))
+        _logger.addHandler(handler)
+
+    _sql.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    _sql.event.listen(engine, "after_cursor_execute", _after_cursor_execute)